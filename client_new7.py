@@ -13,6 +13,8 @@ import struct
 import numpy as np
 import pyaudio
 import time
+import sqlite3
+from collections import namedtuple, deque
 
 # ==============================================================================
 # 全局配置和默认值
@@ -31,28 +33,1235 @@ DELETE_PORT = 9998    # Port for deleting face templates (from clientv7.py)
 
 # These dimensions should match the device side's TARGET_WIDTH and TARGET_HEIGHT for recording
 # Based on '11.py', TARGET_WIDTH = 320, TARGET_HEIGHT = 240
+# 录像现在直接保存设备端的 JPEG，保持原分辨率；此尺寸仅用于人脸模板截图
 RECORDING_WIDTH = 320
 RECORDING_HEIGHT = 240
 RECORDING_FPS = 10     # Consistent with '11.py'
+RECORD_AUDIO = True    # 录像中同时保存音频轨（解码后的 PCM）
+RECORD_MAX_GAP = 10    # 时间戳跳变超过此秒数时不再补帧，直接接续
+AVI_MAX_BYTES = 2 ** 31 - 2 ** 24   # AVI 1.0 文件在许多播放器中不能超过 2GB
+RECORD_SEGMENT_SECONDS = 300        # 每个录像分段的时长
+RECORD_AUDIO_RESET_SECONDS = 3      # 分段中已有音频短于此时长时，音频格式变化不切分段而是重置音轨
+RECORD_QUOTA_BYTES = 20 * 1024 ** 3 # 录像目录总大小上限，超出时删除最旧的分段；None 表示不限
+RECORD_MAX_AGE_DAYS = 30            # 分段最长保留天数；None 表示不限
+RETENTION_CHECK_SECONDS = 60
+# 分段旁的 .idx 索引：头部为 魔数、版本、帧率、段起始采集时间，之后每帧一条定长记录
+# （采集时间、JPEG 数据在 AVI 中的字节偏移、长度），第 n 帧位于 头部 + n * 记录长度
+SEGMENT_INDEX_MAGIC = b"LMIX"
+SEGMENT_INDEX_HEADER = struct.Struct("<4sHHd")
+SEGMENT_INDEX_RECORD = struct.Struct("<dQI")
+SEGMENT_INDEX_DTYPE = np.dtype([("ts", "<f8"), ("offset", "<u8"), ("size", "<u4")])
+PLAYBACK_BUFFER_FRAMES = 30         # 历史回放预取的已解码帧数
+# 录像目录：sqlite 数据库记录每段录像的时长、帧数、分辨率、起止时间和缩略图，
+# 分段关闭时增量写入，历史浏览器分页查询，不需要打开视频文件
+CATALOG_DB = "catalog.db"           # 位于录像目录下
+CATALOG_THUMBS = 3                  # 每段录像的缩略图数（首、中、尾）
+CATALOG_THUMB_SIZE = (128, 96)
+CATALOG_PAGE_SIZE = 20
+# 活动索引：录制时对已解码的帧缩到 64x48 灰度做帧差，变化像素比例按秒取最大值，
+# 以万分比 u16 存入分段旁的 .act 文件（头部为 魔数、版本、保留、段起始采集时间）
+ACTIVITY_SIZE = (64, 48)
+ACTIVITY_PIXEL_DIFF = 20
+ACTIVITY_THRESHOLD = 100            # 万分比，达到即视为有活动
+ACTIVITY_PAD_SECONDS = 1            # 只播放活动片段时，每段活动前多播的秒数
+ACTIVITY_MAGIC = b"LMAC"
+ACTIVITY_HEADER = struct.Struct("<4sHHd")
+# 录像模式："continuous" 连续录像；"motion" 只在有活动时录像。活动来自设备端的检测标记
+# （FLAG_ACTIVITY）或客户端帧差分数，预录/后录时长按采集时间戳计
+RECORD_MODE = "continuous"
+RECORD_PREROLL_SECONDS = 5          # 内存中保留的活动前画面
+RECORD_POSTROLL_SECONDS = 10        # 最后一次活动后继续录制的时长
+RECORD_TRIGGER_THRESHOLD = ACTIVITY_THRESHOLD   # 帧差分数（万分比）达到即触发录像
+PLAYBACK_SPEEDS = [1, 2, 4, 8]
+
+# 传输协议 v2 帧头（与设备端 faceDetectv7.1.py 一致）：
+# 魔数 "LM"、版本、通道、标志、保留、序号 u32、采集时间 u64(微秒)、长度 u32
+WIRE_MAGIC = b"LM"
+WIRE_HEADER = struct.Struct(">2sBBBxIQI")
+CH_VIDEO, CH_AUDIO, CH_STATE = 1, 2, 3
+FLAG_KEEPALIVE = 0x01
+FLAG_MORE = 0x02       # 分片：后面还有同一消息的分片，分片之间可能穿插其他通道的消息
+FLAG_SILENCE = 0x04    # 音频静音标记：负载为 u32 静音采样数（每声道），客户端补零播放
+FLAG_ACTIVITY = 0x08   # 视频帧/保活：设备端检测到人脸或运动
+CHANNEL_TAGS = {CH_VIDEO: b"VIDEO", CH_AUDIO: b"AUDIO", CH_STATE: b"STATE"}
+TAG_CHANNELS = {b"VIDEO": CH_VIDEO, b"KEEPA": CH_VIDEO, b"AUDIO": CH_AUDIO, b"STATE": CH_STATE}
+MAX_PAYLOAD = 1024 * 1024 * 5
+RECV_BUFFER_INITIAL = 64 * 1024   # 接收缓冲区初始大小，按需翻倍
+
+# 音频编码协商：会话开始时发给设备端，设备端回控制消息告知实际格式
+AUDIO_REQUEST = "AUDIO codecs=ulaw,pcm16 rate=16000 channels=1"
+DEFAULT_AUDIO_FORMAT = {"codec": "pcm16", "rate": 44100, "channels": 2}
+
+def _build_ulaw_decode_table():
+    u = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (u >> 4) & 0x07
+    mantissa = u & 0x0F
+    mag = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return np.where(u & 0x80, -mag, mag).astype(np.int16)
+
+ULAW_DECODE_TABLE = _build_ulaw_decode_table()
+
+# 抖动缓冲：目标缓冲时长按到达抖动自适应，限制在 [MIN, MAX] 之间
+JITTER_MIN_DELAY = 0.06        # 秒
+JITTER_MAX_DELAY = 0.5
+JITTER_PLC_MAX = 0.12          # 缓冲空时最多用丢包隐藏补多长，超过后停播重新缓冲
+AV_SYNC_MAX_DELAY = 1.0        # 视频为等待音频时钟最多延后显示的时长
+JITTER_REPORT_INTERVAL = 10    # 秒
+
+# 客户端流水线：接收/分发 -> 解码 -> 显示（只保留最新帧）/ 录像；音频由 AudioPlayer 播放。
+# 各队列满时丢最旧的一项并计数，接收线程永不阻塞（否则音频也会被拖住）
+CLIENT_DECODE_QUEUE = 2        # 待解码 JPEG，实时画面只需要最新的
+CLIENT_RECORD_QUEUE = 300      # 待写录像的视频/音频块，约 5 秒，容忍磁盘短暂变慢
+CLIENT_STOP_TIMEOUT = 10       # 停止时等待录像阶段写完队列中剩余数据的最长秒数
+CLIENT_REPORT_INTERVAL = 10    # 秒
+DISPLAY_REFRESH_HZ = 60        # Tk 显示定时器频率上限，不超过屏幕刷新率
+DISPLAY_SYNC_FRAMES = 32       # 等待音频时钟的已解码帧最多保留数
+
+# JPEG 缩小解码：libjpeg 在 DCT 阶段直接输出 1/2、1/4、1/8 尺寸，比全尺寸解码再缩放快得多
+REDUCED_DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                        4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# 从 JPEG 的 SOF 段读出 (宽, 高)，不解码；解析失败返回 None
+def jpeg_dimensions(data):
+    i, n = 2, len(data)
+    while i + 9 < n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (data[i + 7] << 8) | data[i + 8], (data[i + 5] << 8) | data[i + 6]
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
+
+# 在缩小后仍不小于目标尺寸的前提下取最大的缩小倍数
+def reduced_decode_factor(full_size, target_size):
+    if not full_size or not target_size:
+        return 1
+    for factor in (8, 4, 2):
+        if full_size[0] // factor >= target_size[0] and full_size[1] // factor >= target_size[1]:
+            return factor
+    return 1
+
+# 按宽高比把 (宽, 高) 的图像放进 box，返回显示尺寸
+def fit_size(size, box):
+    aspect_ratio = size[0] / size[1]
+    if box[0] / box[1] > aspect_ratio:
+        return int(box[1] * aspect_ratio), box[1]
+    return box[0], int(box[0] / aspect_ratio)
+
+# tag 为兼容旧格式的 5 字节头（VIDEO/AUDIO/STATE/KEEPA），旧格式下 seq/ts 为 None
+StreamMessage = namedtuple("StreamMessage", "tag channel seq ts flags payload")
+
+# ==============================================================================
+# AudioPlayer 类
+# 抖动缓冲 + 独立播放线程。音频块按设备端采集时间戳排序，播放线程用 PyAudio
+# 的阻塞写自然按声卡时钟取数；缺块时重复上一块并逐次衰减（丢包隐藏），
+# 过期的块丢弃。当前播放到的采集时间即音频时钟，视频按它对齐显示。
+# ==============================================================================
+class AudioPlayer:
+    def __init__(self, pa):
+        self.pa = pa
+        self.stream = None
+        self.format = dict(DEFAULT_AUDIO_FORMAT)
+        self.reopen = True
+        self.cond = threading.Condition()
+        self.blocks = []           # 按时间戳排序的 (ts, pcm)
+        self.running = False
+        self.thread = None
+
+        self.jitter = 0.0          # 到达抖动估计（秒），RFC 3550 式平滑
+        self.last_transit = None
+        self.next_ts = None        # 下一个要播放的采样的采集时间；None 表示正在缓冲
+        self.last_pcm = None
+        self.concealed_run = 0.0
+        self.clock_ts = None       # 音频时钟锚点：(采集时间, 本地时间)
+        self.clock_wall = 0.0
+        self.stats = {"late": 0, "dropped": 0, "concealed": 0, "underruns": 0, "played": 0}
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(timeout=2)
+            self.thread = None
+        self._close_stream()
+
+    def _close_stream(self):
+        if self.stream:
+            try:
+                self.stream.stop_stream()
+                self.stream.close()
+            except Exception as e:
+                print(f"[AudioPlayer] 音频流停止或关闭时出错: {e}")
+            finally:
+                self.stream = None
+
+    def _duration(self, pcm):
+        return len(pcm) / float(self.format["rate"] * self.format["channels"] * 2)
+
+    def set_format(self, fmt):
+        with self.cond:
+            if fmt == self.format:
+                return
+            self.format = dict(fmt)
+            self.reopen = True
+            self.blocks = []
+            self.next_ts = None
+            self.last_pcm = None
+            self.cond.notify_all()
+
+    def target_delay(self):
+        return min(JITTER_MAX_DELAY, max(JITTER_MIN_DELAY, 4 * self.jitter))
+
+    def depth(self):
+        if not self.blocks:
+            return 0.0
+        ts, pcm = self.blocks[-1]
+        start = self.next_ts if self.next_ts is not None else self.blocks[0][0]
+        return max(0.0, ts + self._duration(pcm) - start)
+
+    # ts 为设备端采集时间；旧协议没有时间戳时用到达时间代替
+    def push(self, ts, pcm):
+        now = time.time()
+        if ts is None:
+            ts = now
+        with self.cond:
+            transit = now - ts
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16.0
+            self.last_transit = transit
+            if self.next_ts is not None and ts + self._duration(pcm) <= self.next_ts:
+                self.stats["late"] += 1
+                return
+            i = len(self.blocks)
+            while i > 0 and self.blocks[i - 1][0] > ts:
+                i -= 1
+            self.blocks.insert(i, (ts, pcm))
+            # 缓冲远超目标（例如网络突发后）时丢最旧的块追上实时
+            limit = max(2 * self.target_delay(), self.target_delay() + 0.1)
+            while len(self.blocks) > 1 and self.depth() > limit:
+                ts0, pcm0 = self.blocks.pop(0)
+                self.next_ts = ts0 + self._duration(pcm0) if self.next_ts is not None else None
+                self.stats["dropped"] += 1
+            self.cond.notify()
+
+    # 取下一段要播放的 PCM；缓冲中时阻塞等待，返回 (起始采集时间, pcm)
+    def _next_block(self):
+        with self.cond:
+            while self.running and not self.reopen:
+                if self.next_ts is None:
+                    # 缓冲到目标时长后从最早的块开始播放
+                    if self.blocks and self.depth() >= self.target_delay():
+                        self.next_ts = self.blocks[0][0]
+                    else:
+                        self.cond.wait(0.05)
+                        continue
+                while self.blocks and self.blocks[0][0] + self._duration(self.blocks[0][1]) <= self.next_ts:
+                    self.blocks.pop(0)
+                    self.stats["late"] += 1
+                gap = self.blocks[0][0] - self.next_ts if self.blocks else None
+                # 时间戳有毫秒级抖动：空缺或重叠不到半块时视为相接，整块紧接着播放；
+                # 空缺达到半块才算丢包，重叠超过半块才裁掉重叠的前缀
+                half = self._duration(self.blocks[0][1]) / 2 if self.blocks else 0.0
+                if gap is not None and gap < half:
+                    ts, pcm = self.blocks.pop(0)
+                    if gap <= -half:
+                        skip = int(-gap * self.format["rate"]) * self.format["channels"] * 2
+                        pcm = pcm[skip:]
+                    self.concealed_run = 0.0
+                    self.last_pcm = pcm
+                    start = self.next_ts
+                    self.next_ts = start + self._duration(pcm)
+                    return start, pcm
+                if self.last_pcm is None or self.concealed_run >= JITTER_PLC_MAX:
+                    # 断流太久：停播，等缓冲重新攒够
+                    self.stats["underruns"] += 1
+                    self.next_ts = None
+                    self.clock_ts = None
+                    self.last_pcm = None
+                    continue
+                # 丢包隐藏：重复上一块并衰减，长度不超过空缺
+                pcm = self.last_pcm
+                if gap is not None:
+                    frame = self.format["channels"] * 2
+                    pcm = pcm[:max(frame, int(gap * self.format["rate"]) * frame)]
+                pcm = (np.frombuffer(pcm, np.int16) * 0.5).astype(np.int16).tobytes()
+                self.last_pcm = pcm
+                self.stats["concealed"] += 1
+                start = self.next_ts
+                self.next_ts = start + self._duration(pcm)
+                self.concealed_run += self._duration(pcm)
+                return start, pcm
+            return None, None
+
+    def run(self):
+        last_report = time.time()
+        while self.running:
+            if self.reopen:
+                with self.cond:
+                    fmt = dict(self.format)
+                    self.reopen = False
+                self._close_stream()
+                try:
+                    self.stream = self.pa.open(format=pyaudio.paInt16, channels=fmt["channels"],
+                                               rate=fmt["rate"], output=True)
+                    print(f"[AudioPlayer] 音频格式: {fmt}")
+                except Exception as e:
+                    print(f"[AudioPlayer] 打开音频流失败: {e}")
+                    self.stream = None
+            start, pcm = self._next_block()
+            if pcm is None:
+                continue
+            try:
+                if self.stream:
+                    self.stream.write(pcm)
+                else:
+                    time.sleep(self._duration(pcm))
+            except Exception as e:
+                print(f"[AudioPlayer] 音频播放错误: {e}")
+            self.stats["played"] += 1
+            latency = self.stream.get_output_latency() if self.stream else 0.0
+            with self.cond:
+                if self.next_ts is not None:
+                    self.clock_ts = start + self._duration(pcm) - latency
+                    self.clock_wall = time.time()
+            if time.time() - last_report >= JITTER_REPORT_INTERVAL:
+                last_report = time.time()
+                print(f"[AudioPlayer] 抖动缓冲: {self.report()}")
+
+    # 当前扬声器正在播放的采集时间；未在播放时返回 None
+    def clock(self):
+        with self.cond:
+            if self.clock_ts is None:
+                return None
+            return self.clock_ts + min(time.time() - self.clock_wall, 0.1)
+
+    # 视频帧（采集时间 ts）距离按音频时钟应显示的时刻还需等待的秒数
+    def video_delay(self, ts):
+        now = self.clock()
+        if now is None or ts is None:
+            return 0.0
+        return min(AV_SYNC_MAX_DELAY, max(0.0, ts - now))
+
+    def report(self):
+        with self.cond:
+            info = {"depth_ms": round(self.depth() * 1000), "target_ms": round(self.target_delay() * 1000),
+                    "jitter_ms": round(self.jitter * 1000, 1), "buffered": len(self.blocks)}
+        info.update(self.stats)
+        return info
+
+# ==============================================================================
+# StageQueue 类
+# 流水线阶段之间的有界队列，满时丢弃最旧的一项（与设备端 LatestQueue 相同）
+# ==============================================================================
+class StageQueue:
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.puts = 0
+        self.drops = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.cond:
+            while len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.drops += 1
+            self.items.append(item)
+            self.puts += 1
+            self.cond.notify()
+
+    # 超时返回 None，便于调用方检查 running
+    def get(self, timeout=0.5):
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+# ==============================================================================
+# MjpegAviWriter 类
+# 纯 Python 的 MJPEG AVI 封装：设备端发来的 JPEG 原样写入 '00dc' 块，不解码也不
+# 重新编码；可选 PCM 音频轨写入 '01wb' 块。关闭时补写 idx1 索引并回填头部的帧数、
+# 长度和尺寸。固定帧率 RECORDING_FPS，按采集时间戳补重复帧，保证时间轴正确
+# ==============================================================================
+class MjpegAviWriter:
+    AVIF_HASINDEX = 0x10
+    AVIF_ISINTERLEAVED = 0x100
+    AVIIF_KEYFRAME = 0x10
+
+    def __init__(self, path, fps=RECORDING_FPS, audio=RECORD_AUDIO, index_path=None, activity_path=None):
+        self.path = path
+        self.activity_path = activity_path
+        self.activity = []             # 第 n 秒的活动分数（万分比）
+        self.fps = fps
+        self.has_audio = audio
+        self.size = None               # 首帧的 (宽, 高)
+        self.audio_format = None       # 首个音频块的格式，之后格式不同的块丢弃
+        self.start_ts = None
+        self.last_jpeg = None
+        self.frames = 0
+        self.audio_samples = 0
+        self.skipped = 0
+        self.audio_dropped = 0
+        self.max_chunk = 0
+        self.index = []                # (块 ID, 相对 movi 的偏移, 长度)
+        self.index_file = open(index_path, "wb") if index_path else None
+        self.file = open(path, "wb")
+        self.file.write(self._header())
+        self.movi_pos = self.file.tell()
+        self.file.write(b"LIST\0\0\0\0movi")
+
+    def isOpened(self):
+        return self.file is not None
+
+    @property
+    def bytes_written(self):
+        return self.file.tell() if self.file else 0
+
+    def _chunk(self, fourcc, size, body):
+        return fourcc + struct.pack("<I", size) + body
+
+    def _list(self, kind, body):
+        return self._chunk(b"LIST", len(body) + 4, kind + body)
+
+    # 头部各字段长度固定，打开时先写占位值，关闭时用最终值原位重写
+    def _header(self):
+        width, height = self.size or (RECORDING_WIDTH, RECORDING_HEIGHT)
+        streams = 2 if self.has_audio else 1
+        flags = self.AVIF_HASINDEX | (self.AVIF_ISINTERLEAVED if self.has_audio else 0)
+        avih = struct.pack("<14I", int(1000000 / self.fps), self.max_chunk * self.fps, 0, flags,
+                           self.frames, 0, streams, self.max_chunk, width, height, 0, 0, 0, 0)
+        strh = struct.pack("<4s4sIHHIIIIIIIIhhhh", b"vids", b"MJPG", 0, 0, 0, 0, 1, self.fps, 0,
+                           self.frames, self.max_chunk, 0xFFFFFFFF, 0, 0, 0, width, height)
+        strf = struct.pack("<IiiHH4sIiiII", 40, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0)
+        body = self._chunk(b"avih", len(avih), avih)
+        body += self._list(b"strl", self._chunk(b"strh", len(strh), strh) + self._chunk(b"strf", len(strf), strf))
+        if self.has_audio:
+            fmt = self.audio_format or DEFAULT_AUDIO_FORMAT
+            block = fmt["channels"] * 2
+            strh = struct.pack("<4s4sIHHIIIIIIIIhhhh", b"auds", b"\0\0\0\0", 0, 0, 0, 0, block,
+                               fmt["rate"] * block, 0, self.audio_samples, fmt["rate"] * block, 0xFFFFFFFF,
+                               block, 0, 0, 0, 0)
+            strf = struct.pack("<HHIIHHH", 1, fmt["channels"], fmt["rate"], fmt["rate"] * block, block, 16, 0)
+            body += self._list(b"strl", self._chunk(b"strh", len(strh), strh) + self._chunk(b"strf", len(strf), strf))
+        hdrl = self._list(b"hdrl", body)
+        return b"RIFF\0\0\0\0AVI " + hdrl
+
+    def _write_chunk(self, fourcc, data):
+        if self.bytes_written + len(data) > AVI_MAX_BYTES:
+            return False
+        self.index.append((fourcc, self.file.tell() - self.movi_pos - 8, len(data)))
+        self.file.write(fourcc + struct.pack("<I", len(data)))
+        self.file.write(data)
+        if len(data) & 1:
+            self.file.write(b"\0")
+        self.max_chunk = max(self.max_chunk, len(data))
+        return True
+
+    def _write_frame(self, jpeg):
+        offset = self.file.tell() + 8
+        if not self._write_chunk(b"00dc", jpeg):
+            return False
+        if self.index_file:
+            if self.frames == 0:
+                self.index_file.write(SEGMENT_INDEX_HEADER.pack(SEGMENT_INDEX_MAGIC, 1, self.fps, self.start_ts))
+            self.index_file.write(SEGMENT_INDEX_RECORD.pack(self.start_ts + self.frames / float(self.fps),
+                                                            offset, len(jpeg)))
+        self.frames += 1
+        return True
+
+    # jpeg 为 None 表示设备端静止保活，重复上一帧；ts 为采集时间（秒）
+    def write_video(self, jpeg, ts=None):
+        if self.file is None:
+            return False
+        if ts is None:
+            ts = time.time()
+        if self.start_ts is None:
+            self.start_ts = ts
+        if jpeg is None:
+            jpeg = self.last_jpeg
+            if jpeg is None:
+                return False
+        elif self.size is None:
+            self.size = jpeg_dimensions(jpeg)
+        slot = int(round((ts - self.start_ts) * self.fps))
+        if slot < self.frames:
+            # 比帧率快：本槽已有画面，留到下一个槽补帧时使用
+            self.last_jpeg = jpeg
+            self.skipped += 1
+            return True
+        gap = slot - self.frames
+        if gap > RECORD_MAX_GAP * self.fps:
+            self.start_ts += (gap - RECORD_MAX_GAP * self.fps) / float(self.fps)
+            gap = RECORD_MAX_GAP * self.fps
+        for _ in range(gap if self.last_jpeg is not None else 0):
+            if not self._write_frame(self.last_jpeg):
+                return False
+        if not self._write_frame(jpeg):
+            return False
+        self.last_jpeg = jpeg
+        return True
+
+    # pcm 为 int16 交织采样，fmt 为其 {"rate", "channels"}
+    def write_audio(self, pcm, fmt, ts=None):
+        if self.file is None or not self.has_audio or not pcm:
+            return False
+        if self.audio_format is None:
+            self.audio_format = {"codec": "pcm16", "rate": fmt["rate"], "channels": fmt["channels"]}
+        elif (fmt["rate"], fmt["channels"]) != (self.audio_format["rate"], self.audio_format["channels"]):
+            self.audio_dropped += 1
+            return False
+        block = fmt["channels"] * 2
+        if ts is not None:
+            if self.start_ts is None:
+                self.start_ts = ts
+            # 音频中断（丢包、设备暂停）超过 0.1 秒时补静音，保持与视频对齐
+            missing = int((ts - self.start_ts) * fmt["rate"]) - self.audio_samples
+            if missing > fmt["rate"] // 10:
+                missing = min(missing, RECORD_MAX_GAP * fmt["rate"])
+                if not self._write_chunk(b"01wb", bytes(missing * block)):
+                    return False
+                self.audio_samples += missing
+        if not self._write_chunk(b"01wb", pcm):
+            return False
+        self.audio_samples += len(pcm) // block
+        return True
+
+    # 改用新的音频格式：已写入的音频块原位改为 JUNK 块并移出索引，之后按新格式从段起始对齐
+    # （write_audio 会为段起始到新音频之间补静音）。用于会话开头格式协商完成前的短暂旧格式音频
+    def reset_audio(self, fmt):
+        end = self.file.tell()
+        for ck, off, size in self.index:
+            if ck == b"01wb":
+                self.file.seek(self.movi_pos + 8 + off)
+                self.file.write(b"JUNK")
+        self.file.seek(end)
+        self.index = [entry for entry in self.index if entry[0] != b"01wb"]
+        self.audio_format = {"codec": "pcm16", "rate": fmt["rate"], "channels": fmt["channels"]}
+        self.audio_samples = 0
+
+    # 第 int(ts - 段起始) 秒的活动分数取最大值
+    def write_activity(self, score, ts):
+        if self.file is None or self.start_ts is None or ts is None or ts < self.start_ts:
+            return
+        second = int(ts - self.start_ts)
+        if second >= len(self.activity):
+            self.activity.extend([0] * (second + 1 - len(self.activity)))
+        self.activity[second] = max(self.activity[second], min(10000, int(score * 10000)))
+
+    def release(self):
+        if self.file is None:
+            return
+        if self.activity_path and self.start_ts is not None:
+            try:
+                with open(self.activity_path, "wb") as af:
+                    af.write(ACTIVITY_HEADER.pack(ACTIVITY_MAGIC, 1, 0, self.start_ts))
+                    af.write(np.array(self.activity, dtype="<u2").tobytes())
+            except OSError as e:
+                print(f"[MjpegAviWriter] 活动索引写入失败 {self.activity_path}: {e}")
+        f, self.file = self.file, None
+        end = f.tell()
+        idx = b"".join(struct.pack("<4sIII", ck, self.AVIIF_KEYFRAME, off, size) for ck, off, size in self.index)
+        f.write(b"idx1" + struct.pack("<I", len(idx)) + idx)
+        total = f.tell()
+        f.seek(0)
+        f.write(self._header())
+        f.seek(4)
+        f.write(struct.pack("<I", total - 8))
+        f.seek(self.movi_pos + 4)
+        f.write(struct.pack("<I", end - self.movi_pos - 8))
+        f.close()
+        if self.index_file:
+            self.index_file.close()
+            self.index_file = None
+        print(f"[MjpegAviWriter] 录像已保存: {self.path} 帧数 {self.frames}, 音频采样 {self.audio_samples}, "
+              f"跳过 {self.skipped}, 丢弃音频块 {self.audio_dropped}")
+
+def segment_index_path(avi_path):
+    return os.path.splitext(avi_path)[0] + ".idx"
+
+def activity_index_path(avi_path):
+    return os.path.splitext(avi_path)[0] + ".act"
+
+# 读取分段的活动索引，返回每秒分数数组（万分比）；没有索引返回 None
+def load_activity(avi_path):
+    try:
+        with open(activity_index_path(avi_path), "rb") as f:
+            data = f.read()
+        magic = ACTIVITY_HEADER.unpack_from(data)[0]
+    except (OSError, struct.error):
+        return None
+    if magic != ACTIVITY_MAGIC:
+        return None
+    return np.frombuffer(data, dtype="<u2", offset=ACTIVITY_HEADER.size)
+
+# second 之后（跳过当前这段活动）下一段活动开始的秒数；没有返回 None
+def next_activity(activity, second, threshold=ACTIVITY_THRESHOLD):
+    active = activity >= threshold
+    second = max(0, second)
+    quiet = np.flatnonzero(~active[second:])
+    if not len(quiet):
+        return None
+    following = np.flatnonzero(active[second + quiet[0]:])
+    if not len(following):
+        return None
+    return int(second + quiet[0] + following[0])
+
+# ------------------------------------------------------------------------------
+# 帧差活动量：缩小到 ACTIVITY_SIZE 的灰度图与上一帧比较，返回变化像素比例
+# ------------------------------------------------------------------------------
+class ActivityMeter:
+    def __init__(self):
+        self.prev = None
+
+    def score(self, frame):
+        small = cv2.cvtColor(cv2.resize(frame, ACTIVITY_SIZE, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        prev, self.prev = self.prev, small
+        if prev is None:
+            return 0.0
+        return float(np.count_nonzero(cv2.absdiff(small, prev) > ACTIVITY_PIXEL_DIFF)) / small.size
+
+# ==============================================================================
+# SegmentedRecorder 类
+# 按 RECORD_SEGMENT_SECONDS 切分录像，每段一个 AVI 加一个 .idx 帧索引。
+# 接口与 MjpegAviWriter 相同，StreamClient 和录像阶段无需区分
+# ==============================================================================
+class SegmentedRecorder:
+    def __init__(self, directory, segment_seconds=RECORD_SEGMENT_SECONDS, on_segment_closed=None):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.on_segment_closed = on_segment_closed   # 分段写完后以其路径回调（例如更新录像目录）
+        self.writer = None
+        self._open()
+
+    def _close_writer(self):
+        path = self.writer.path
+        self.writer.release()
+        if self.on_segment_closed:
+            try:
+                self.on_segment_closed(path)
+            except Exception as e:
+                print(f"[SegmentedRecorder] 分段关闭回调出错 {path}: {e}")
+
+    def _open(self):
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(self.directory, stamp + ".avi")
+        n = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, f"{stamp}_{n}.avi")
+            n += 1
+        previous = self.writer
+        self.writer = MjpegAviWriter(path, index_path=segment_index_path(path),
+                                     activity_path=activity_index_path(path))
+        if previous is not None:
+            # 新分段开头的保活仍能重复上一段最后一帧
+            self.writer.last_jpeg = previous.last_jpeg
+        print(f"[SegmentedRecorder] 新录像分段: {path}")
+
+    def _rotate(self):
+        self._close_writer()
+        self._open()
+
+    @property
+    def path(self):
+        return self.writer.path if self.writer else None
+
+    def isOpened(self):
+        return self.writer is not None and self.writer.isOpened()
+
+    def write_video(self, jpeg, ts=None):
+        w = self.writer
+        if w.frames >= self.segment_seconds * w.fps or \
+                w.bytes_written + len(jpeg or b"") * (RECORD_MAX_GAP * w.fps + 1) > AVI_MAX_BYTES:
+            self._rotate()
+        return self.writer.write_video(jpeg, ts)
+
+    def write_audio(self, pcm, fmt, ts=None):
+        w = self.writer
+        if w.audio_format and \
+                (fmt["rate"], fmt["channels"]) != (w.audio_format["rate"], w.audio_format["channels"]):
+            if w.audio_samples < RECORD_AUDIO_RESET_SECONDS * w.audio_format["rate"]:
+                # 会话开头协商前的旧格式音频：本段改用新格式，不留下只有几帧的分段
+                w.reset_audio(fmt)
+            else:
+                # 音频格式变化：另起一段，新段头部写新格式
+                self._rotate()
+        return self.writer.write_audio(pcm, fmt, ts)
+
+    def write_activity(self, score, ts):
+        self.writer.write_activity(score, ts)
+
+    # 连续录像不需要触发
+    def trigger(self, ts):
+        pass
+
+    def release(self):
+        if self.writer:
+            self._close_writer()
+            self.writer = None
+
+# ==============================================================================
+# MotionRecorder 类
+# 活动触发录像：空闲时只在内存中保留最近 preroll 秒的音视频；帧差分数达到
+# RECORD_TRIGGER_THRESHOLD 或设备端标记活动时，新开一个 SegmentedRecorder，先写入预录
+# 内容再接着录，最后一次活动后再录 postroll 秒即关闭。按天统计写入和省下的字节数。
+# 接口与 SegmentedRecorder 相同
+# ==============================================================================
+class MotionRecorder:
+    def __init__(self, directory, on_segment_closed=None,
+                 preroll=RECORD_PREROLL_SECONDS, postroll=RECORD_POSTROLL_SECONDS):
+        self.directory = directory
+        self.on_segment_closed = on_segment_closed
+        self.preroll = preroll
+        self.postroll = postroll
+        self.recorder = None           # 活动期间的分段录像，空闲时为 None
+        self.pending = deque()         # 预录缓冲 (种类, 时间戳, 数据, 字节数, 采集时间)
+        self.base_jpeg = None          # 最后一帧已丢弃或已写入的画面，新录像开头的保活用它重复
+        self.active_until = None
+        self.opened = True
+        self.daily = {}                # 日期 -> {"events": 活动段数, "written": 字节数, "skipped": 字节数}
+        print(f"[MotionRecorder] 活动触发录像：预录 {preroll} 秒，后录 {postroll} 秒")
+
+    @property
+    def path(self):
+        return self.recorder.path if self.recorder else None
+
+    def isOpened(self):
+        return self.opened
+
+    def _count(self, key, when, nbytes):
+        day = datetime.date.fromtimestamp(when).isoformat()
+        if day not in self.daily:
+            for old in list(self.daily):
+                print(f"[MotionRecorder] {self.report(old)}")
+                del self.daily[old]
+            self.daily[day] = {"events": 0, "written": 0, "skipped": 0}
+        self.daily[day][key] += nbytes
+
+    # 某天（默认最近一天）的存储统计
+    def report(self, day=None):
+        if day is None:
+            if not self.daily:
+                return "尚无数据"
+            day = max(self.daily)
+        st = self.daily[day]
+        total = st["written"] + st["skipped"]
+        saved = st["skipped"] / float(total) if total else 0.0
+        return (f"{day} 活动 {st['events']} 段，写入 {st['written'] / 1048576.0:.1f} MB，"
+                f"节省 {st['skipped'] / 1048576.0:.1f} MB ({saved:.0%})")
+
+    def _write(self, kind, ts, data):
+        if kind == "audio":
+            return self.recorder.write_audio(data[0], data[1], ts)
+        if kind == "activity":
+            return self.recorder.write_activity(data, ts)
+        return self.recorder.write_video(data, ts)
+
+    def _start_event(self, when):
+        try:
+            self.recorder = SegmentedRecorder(self.directory, on_segment_closed=self.on_segment_closed)
+        except OSError as e:
+            print(f"[MotionRecorder] 无法打开录像分段: {e}")
+            return
+        self.recorder.writer.last_jpeg = self.base_jpeg
+        self._count("events", when, 1)
+        pending, self.pending = self.pending, deque()
+        print(f"[MotionRecorder] 检测到活动，开始录像（预录 {len(pending)} 条）")
+        for kind, ts, data, nbytes, when in pending:
+            self._count("written", when, nbytes)
+            # 旧协议没有采集时间戳：按入缓冲时的到达时间回放，否则写入器会把整段预录记在同一时刻
+            self._write(kind, ts if ts is not None else when, data)
+
+    def _stop_event(self):
+        self.base_jpeg = self.recorder.writer.last_jpeg
+        self.recorder.release()
+        self.recorder = None
+        self.active_until = None
+        print(f"[MotionRecorder] 活动结束，录像已关闭。{self.report()}")
+
+    def _push(self, kind, ts, data, nbytes):
+        when = ts if ts is not None else time.time()
+        if self.recorder is not None and when > self.active_until:
+            self._stop_event()
+        if self.recorder is not None:
+            self._count("written", when, nbytes)
+            return self._write(kind, ts, data)
+        self.pending.append((kind, ts, data, nbytes, when))
+        while self.pending[0][4] < when - self.preroll:
+            kind, _, data, nbytes, old = self.pending.popleft()
+            if kind == "video" and data is not None:
+                self.base_jpeg = data
+            self._count("skipped", old, nbytes)
+        return True
+
+    # 设备端检测或帧差触发：空闲时开始录像，录制中则顺延结束时间
+    def trigger(self, ts):
+        when = ts if ts is not None else time.time()
+        if self.recorder is None:
+            self._start_event(when)
+            if self.recorder is None:
+                return
+        self.active_until = max(self.active_until or when, when + self.postroll)
+
+    def write_video(self, jpeg, ts=None):
+        return self._push("video", ts, jpeg, len(jpeg) if jpeg else 0)
+
+    def write_audio(self, pcm, fmt, ts=None):
+        return self._push("audio", ts, (pcm, fmt), len(pcm))
+
+    def write_activity(self, score, ts):
+        if score * 10000 >= RECORD_TRIGGER_THRESHOLD:
+            self.trigger(ts)
+        self._push("activity", ts, score, 0)
+
+    def release(self):
+        self.opened = False
+        if self.recorder is not None:
+            self._stop_event()
+        while self.pending:
+            _, _, _, nbytes, when = self.pending.popleft()
+            self._count("skipped", when, nbytes)
+        for day in sorted(self.daily):
+            print(f"[MotionRecorder] {self.report(day)}")
+
+# ==============================================================================
+# SegmentIndex 类
+# 读取分段的 .idx 索引。帧 n 的 JPEG 由索引给出偏移直接读出，定位为 O(1)，
+# 不依赖 OpenCV 逐帧查找
+# ==============================================================================
+class SegmentIndex:
+    def __init__(self, avi_path):
+        with open(segment_index_path(avi_path), "rb") as f:
+            data = f.read()
+        if len(data) < SEGMENT_INDEX_HEADER.size:
+            raise ValueError("索引为空")
+        magic, version, self.fps, self.start_ts = SEGMENT_INDEX_HEADER.unpack_from(data)
+        if magic != SEGMENT_INDEX_MAGIC:
+            raise ValueError(f"索引魔数错误: {magic!r}")
+        count = (len(data) - SEGMENT_INDEX_HEADER.size) // SEGMENT_INDEX_RECORD.size
+        self.records = np.frombuffer(data, dtype=SEGMENT_INDEX_DTYPE, count=count,
+                                     offset=SEGMENT_INDEX_HEADER.size)
+        self.file = open(avi_path, "rb")
+
+    def __len__(self):
+        return len(self.records)
+
+    def read_jpeg(self, n):
+        rec = self.records[n]
+        self.file.seek(int(rec["offset"]))
+        return self.file.read(int(rec["size"]))
+
+    # 采集时间 ts 时正在显示的帧号
+    def frame_at(self, ts):
+        n = int(np.searchsorted(self.records["ts"], ts, side="right")) - 1
+        return min(max(n, 0), len(self.records) - 1)
+
+    def close(self):
+        self.file.close()
+
+# 找到包含采集时间 ts 的分段，只读各索引的头部，再只打开这一段的索引；
+# 返回 (AVI 路径, 帧号)，该时间没有录像返回 None
+def find_segment(directory, ts):
+    best = None
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".idx"):
+            continue
+        try:
+            with open(os.path.join(directory, name), "rb") as f:
+                magic, version, fps, start = SEGMENT_INDEX_HEADER.unpack(f.read(SEGMENT_INDEX_HEADER.size))
+        except (OSError, struct.error):
+            continue
+        if magic == SEGMENT_INDEX_MAGIC and start <= ts and (best is None or start > best[1]):
+            best = (os.path.join(directory, name[:-4] + ".avi"), start)
+    if best is None or not os.path.exists(best[0]):
+        return None
+    try:
+        index = SegmentIndex(best[0])
+    except (OSError, ValueError):
+        return None
+    try:
+        if not len(index) or ts >= float(index.records["ts"][-1]) + 1.0 / index.fps:
+            return None
+        return best[0], index.frame_at(ts)
+    finally:
+        index.close()
+
+# ------------------------------------------------------------------------------
+# 带索引的分段用 IndexedCapture 代替 cv2.VideoCapture 播放：接口相同，
+# set(CAP_PROP_POS_FRAMES) 只是改帧号，read() 按偏移读出 JPEG 解码
+# ------------------------------------------------------------------------------
+class IndexedCapture:
+    def __init__(self, index):
+        self.index = index
+        self.pos = 0
+        self.target_size = None    # 显示尺寸，设置后按它选 JPEG 缩小解码倍数
+
+    def isOpened(self):
+        return self.index is not None
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.index))
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.index.fps)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.pos)
+        return 0.0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.pos = min(max(int(value), 0), len(self.index))
+            return True
+        return False
+
+    # grab 只前进一帧，不读也不解码
+    def grab(self):
+        if self.index is None or self.pos >= len(self.index):
+            return False
+        self.pos += 1
+        return True
+
+    def retrieve(self):
+        if self.index is None or self.pos == 0:
+            return False, None
+        jpeg = self.index.read_jpeg(self.pos - 1)
+        factor = 1
+        if self.target_size:
+            full = jpeg_dimensions(jpeg)
+            factor = reduced_decode_factor(full, fit_size(full, self.target_size) if full else None)
+        frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), REDUCED_DECODE_FLAGS[factor])
+        return frame is not None, frame
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+# ==============================================================================
+# PlaybackEngine 类
+# 历史回放的预取引擎：后台线程顺序读取、解码并缩放到显示尺寸，放入有界缓冲；
+# 界面按录制帧率每拍取一帧。只有用户拖动进度条、快进/后退时才定位。
+# N 倍速时每显示一帧跳过 N-1 帧，跳过的帧只 grab 不解码
+# ==============================================================================
+class PlaybackEngine:
+    def __init__(self, cap, total_frames):
+        self.cap = cap
+        self.total = total_frames
+        self.cond = threading.Condition()
+        self.buffer = deque()          # (帧号, RGB 图像)
+        self.generation = 0            # 每次定位加一，丢弃定位前解码的帧
+        self.seek_to = None
+        self.speed = 1
+        self.size = None
+        self.eof = False
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def seek(self, frame):
+        with self.cond:
+            self.generation += 1
+            self.seek_to = min(max(int(frame), 0), max(self.total - 1, 0))
+            self.buffer.clear()
+            self.eof = False
+            self.cond.notify_all()
+
+    # 改变倍速后从当前帧重新预取，缓冲中按旧倍速解码的帧作废
+    def set_speed(self, speed, current):
+        with self.cond:
+            self.speed = speed
+        self.seek(current)
+
+    def resize(self, size):
+        with self.cond:
+            self.size = size
+
+    # 界面每拍取一帧；缓冲为空返回 None
+    def pull(self):
+        with self.cond:
+            if not self.buffer:
+                return None
+            item = self.buffer.popleft()
+            self.cond.notify_all()
+            return item
+
+    def finished(self):
+        with self.cond:
+            return self.eof and not self.buffer
+
+    def run(self):
+        pos = 0
+        while True:
+            with self.cond:
+                while self.running and self.seek_to is None and \
+                        (self.eof or len(self.buffer) >= PLAYBACK_BUFFER_FRAMES):
+                    self.cond.wait()
+                if not self.running:
+                    break
+                generation = self.generation
+                target, self.seek_to = self.seek_to, None
+                step, size = self.speed, self.size
+            if target is not None:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+                pos = target
+            if isinstance(self.cap, IndexedCapture):
+                self.cap.target_size = size
+            ok, frame = self.cap.read()
+            if ok:
+                if size:
+                    display_size = fit_size((frame.shape[1], frame.shape[0]), size)
+                    if display_size != (frame.shape[1], frame.shape[0]):
+                        frame = cv2.resize(frame, display_size)
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                shown = pos
+                pos += 1
+                for _ in range(step - 1):
+                    if not self.cap.grab():
+                        break
+                    pos += 1
+            with self.cond:
+                if generation != self.generation:
+                    continue
+                if ok:
+                    self.buffer.append((shown, frame))
+                else:
+                    self.eof = True
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join(timeout=2)
+        self.cap.release()
+
+def open_recording(path):
+    if os.path.exists(segment_index_path(path)):
+        try:
+            return IndexedCapture(SegmentIndex(path))
+        except (OSError, ValueError) as e:
+            print(f"[MonitoringApp] 分段索引不可用，改用 OpenCV 读取 {path}: {e}")
+    return cv2.VideoCapture(path)
+
+# ==============================================================================
+# RecordingCatalog 类
+# 录像目录（sqlite）。有 .idx 索引的分段只读索引和三帧 JPEG 就能得到全部信息；
+# 旧录像没有索引时用 OpenCV 打开一次，之后按文件修改时间判断是否需要重新登记。
+# 连接在录像线程、保留策略线程和 Tk 线程之间共用，所有访问持锁
+# ==============================================================================
+class RecordingCatalog:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, CATALOG_DB), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS recordings (
+                name TEXT PRIMARY KEY, start_ts REAL, end_ts REAL, duration REAL, frames INTEGER,
+                width INTEGER, height INTEGER, size INTEGER, mtime REAL)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS thumbnails (
+                name TEXT, seq INTEGER, jpeg BLOB, PRIMARY KEY (name, seq))""")
+
+    @staticmethod
+    def _thumbnail(frame):
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, fit_size((w, h), CATALOG_THUMB_SIZE), interpolation=cv2.INTER_AREA)
+        ok, enc = cv2.imencode(".jpg", small, [cv2.IMWRITE_JPEG_QUALITY, 70])
+        return enc.tobytes() if ok else None
+
+    # 缩略图取首、尾及其间等分的帧号，短分段去重
+    @staticmethod
+    def _thumb_positions(frames):
+        if frames <= 0:
+            return []
+        steps = max(1, CATALOG_THUMBS - 1)
+        return sorted({(frames - 1) * i // steps for i in range(CATALOG_THUMBS)})
+
+    def _probe_indexed(self, path):
+        index = SegmentIndex(path)
+        try:
+            frames = len(index)
+            if not frames:
+                return None
+            first = index.read_jpeg(0)
+            width, height = jpeg_dimensions(first) or (0, 0)
+            thumbs = []
+            for n in self._thumb_positions(frames):
+                jpeg = index.read_jpeg(n)
+                full = jpeg_dimensions(jpeg)
+                factor = reduced_decode_factor(full, fit_size(full, CATALOG_THUMB_SIZE) if full else None)
+                frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), REDUCED_DECODE_FLAGS[factor])
+                if frame is not None:
+                    thumbs.append(self._thumbnail(frame))
+            start = float(index.start_ts)
+            end = float(index.records["ts"][-1]) + 1.0 / index.fps
+            return start, end, frames, width, height, thumbs
+        finally:
+            index.close()
+
+    def _probe_video(self, path):
+        cap = cv2.VideoCapture(path)
+        try:
+            if not cap.isOpened():
+                return None
+            frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            thumbs = []
+            for n in self._thumb_positions(frames):
+                cap.set(cv2.CAP_PROP_POS_FRAMES, n)
+                ret, frame = cap.read()
+                if ret:
+                    thumbs.append(self._thumbnail(frame))
+            # 旧录像按文件名里的开始时间，否则按修改时间倒推
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                start = time.mktime(datetime.datetime.strptime(name[:15], "%Y%m%d_%H%M%S").timetuple())
+            except ValueError:
+                start = os.path.getmtime(path) - frames / float(RECORDING_FPS)
+            return start, start + frames / float(RECORDING_FPS), frames, width, height, thumbs
+        finally:
+            cap.release()
+
+    # 登记（或重新登记）一段录像；分段关闭时由 SegmentedRecorder 回调
+    def add(self, path):
+        name = os.path.basename(path)
+        try:
+            if os.path.exists(segment_index_path(path)):
+                info = self._probe_indexed(path)
+            else:
+                info = self._probe_video(path)
+            stat = os.stat(path)
+        except (OSError, ValueError) as e:
+            print(f"[RecordingCatalog] 登记录像失败 {name}: {e}")
+            return False
+        if info is None:
+            return False
+        start, end, frames, width, height, thumbs = info
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (name, start, end, end - start, frames, width, height, stat.st_size, stat.st_mtime))
+            self.db.execute("DELETE FROM thumbnails WHERE name = ?", (name,))
+            self.db.executemany("INSERT INTO thumbnails VALUES (?, ?, ?)",
+                                [(name, i, sqlite3.Binary(t)) for i, t in enumerate(thumbs) if t])
+        return True
+
+    # 与目录内容对齐：登记新增或变化的文件，删除已不存在文件的记录；正在写入的分段跳过
+    def sync(self, active=()):
+        names = {f for f in os.listdir(self.directory) if f.endswith((".avi", ".mp4"))}
+        active = {os.path.basename(p) for p in active}
+        with self.lock:
+            known = dict(self.db.execute("SELECT name, mtime FROM recordings"))
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM recordings WHERE name = ?", [(n,) for n in set(known) - names])
+            self.db.executemany("DELETE FROM thumbnails WHERE name = ?", [(n,) for n in set(known) - names])
+        added = 0
+        for name in sorted(names - active):
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if known.get(name) != mtime and self.add(path):
+                added += 1
+        return added
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM recordings").fetchone()[0]
+
+    # 按文件名（本机录制开始时间）倒序分页，不受设备端时钟偏差影响
+    def page(self, offset, limit=CATALOG_PAGE_SIZE):
+        with self.lock:
+            return self.db.execute("SELECT name, start_ts, end_ts, duration, frames, width, height, size "
+                                   "FROM recordings ORDER BY name DESC LIMIT ? OFFSET ?",
+                                   (limit, offset)).fetchall()
+
+    def thumbnails(self, name):
+        with self.lock:
+            return [bytes(row[0]) for row in self.db.execute(
+                "SELECT jpeg FROM thumbnails WHERE name = ? ORDER BY seq", (name,))]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# 删除超出配额或过期的分段（AVI 及其索引），从最旧的开始；正在写入的分段不删
+def enforce_retention(directory, quota_bytes=RECORD_QUOTA_BYTES, max_age_days=RECORD_MAX_AGE_DAYS, active=()):
+    segments = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".avi"):
+            continue
+        path = os.path.join(directory, name)
+        files = [path] + [p for p in (segment_index_path(path), activity_index_path(path)) if os.path.exists(p)]
+        try:
+            segments.append((path, files, sum(os.path.getsize(f) for f in files), os.path.getmtime(path)))
+        except OSError:
+            continue
+    total = sum(seg[2] for seg in segments)
+    now = time.time()
+    removed = []
+    for path, files, size, mtime in segments:
+        if path in active:
+            continue
+        expired = max_age_days is not None and now - mtime > max_age_days * 86400
+        if not expired and (quota_bytes is None or total <= quota_bytes):
+            continue
+        try:
+            for f in files:
+                os.remove(f)
+        except OSError as e:
+            print(f"[MonitoringApp] 删除录像分段失败 {path}: {e}")
+            continue
+        total -= size
+        removed.append(os.path.basename(path))
+    return removed
 
 # ==============================================================================
 # StreamClient 类 (统一版)
 # 处理主视频/音频流的接收和播放
 # ==============================================================================
 class StreamClient:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, on_segment_closed=None, record_mode=RECORD_MODE):
         self.ip = ip
+        self.on_segment_closed = on_segment_closed
+        self.record_mode = record_mode
         self.port = port
         self.conn = None
         self.running = False
         self.audio = None
-        self.audio_stream = None
+        self.player = None
         self.server_socket = None # To hold the listening socket
 
         self.save_path = "./records"
         os.makedirs(self.save_path, exist_ok=True)
         self.writer = None
 
+        self.protocol = None   # 首条消息时检测：1 旧格式 / 2 帧格式
+        self.next_seq = {}
+        self.lost = {}         # 按通道统计的序号缺口
+        self.partial = {}      # 通道 -> (首个分片的消息头, 已收字节数)
+        self.header_buf = bytearray(WIRE_HEADER.size)
+        self.buffer = bytearray(RECV_BUFFER_INITIAL)   # 非分片消息的复用接收缓冲区
+        self.assembly = {}     # 通道 -> 复用的分片重组缓冲区
+        self.audio_format = dict(DEFAULT_AUDIO_FORMAT)
+
     def start(self):
         max_retries = 3
         retry_count = 0
@@ -71,13 +1280,17 @@ class StreamClient:
                 self.running = True
 
                 self.audio = pyaudio.PyAudio()
-                self.audio_stream = self.audio.open(format=pyaudio.paInt16, channels=2, rate=44100, output=True)
+                self.audio_format = dict(DEFAULT_AUDIO_FORMAT)
+                self.player = AudioPlayer(self.audio)
+                self.player.start()
 
-                fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-                fname = datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + ".avi"
-                self.writer = cv2.VideoWriter(os.path.join(self.save_path, fname), fourcc, RECORDING_FPS, (RECORDING_WIDTH, RECORDING_HEIGHT))
-                if not self.writer.isOpened():
-                    raise IOError(f"无法打开视频写入器。检查路径、编解码器或分辨率 ({RECORDING_WIDTH}x{RECORDING_HEIGHT})。")
+                try:
+                    if self.record_mode == "motion":
+                        self.writer = MotionRecorder(self.save_path, on_segment_closed=self.on_segment_closed)
+                    else:
+                        self.writer = SegmentedRecorder(self.save_path, on_segment_closed=self.on_segment_closed)
+                except OSError as e:
+                    raise IOError(f"无法打开录像文件: {e}")
 
                 print("[StreamClient] 开始接收数据...")
                 time.sleep(1)
@@ -112,15 +1325,10 @@ class StreamClient:
             finally:
                 self.server_socket = None
             print("[StreamClient] 服务器套接字已关闭。")
-        if self.audio_stream:
-            try:
-                self.audio_stream.stop_stream()
-                self.audio_stream.close()
-            except Exception as e:
-                print(f"[StreamClient] 音频流停止或关闭时出错: {e}")
-            finally:
-                self.audio_stream = None
-            print("[StreamClient] 音频流已停止并关闭。")
+        if self.player:
+            self.player.stop()
+            print(f"[StreamClient] 音频播放已停止。抖动缓冲统计: {self.player.report()}")
+            self.player = None
         if self.audio:
             try:
                 self.audio.terminate()
@@ -138,61 +1346,144 @@ class StreamClient:
             finally:
                 self.writer = None
 
+    # 设备端协商出新的音频格式后由播放线程按其声道数/采样率重开播放流
+    def set_audio_format(self, fmt):
+        if fmt == self.audio_format:
+            return
+        self.audio_format = dict(fmt)
+        if self.player:
+            self.player.set_format(fmt)
+
+    def decode_audio(self, data, flags=0):
+        if flags & FLAG_SILENCE:
+            # 舒适静音：按采样数生成零值 PCM，保持播放时间轴不变
+            samples = struct.unpack(">I", bytes(data[:4]))[0]
+            return bytes(samples * self.audio_format["channels"] * 2)
+        if self.audio_format["codec"] == "ulaw":
+            return ULAW_DECODE_TABLE[np.frombuffer(data, dtype=np.uint8)].tobytes()
+        # data 是接收缓冲区的视图，交给抖动缓冲前必须拷贝
+        return bytes(data)
+
     def send_command(self, command):
         if self.conn and self.running:
             try:
-                self.conn.sendall(command.encode('utf-8'))
+                # 每条命令以换行结尾，设备端按行拆分
+                self.conn.sendall((command + "\n").encode('utf-8'))
                 print(f"[StreamClient] 已发送命令: {command}")
             except Exception as e:
                 print(f"[StreamClient] 发送命令失败: {e}。连接可能已丢失。")
                 self.running = False
 
-    def read_stream(self):
+    # 把 view 填满；连接关闭返回 False。正确处理任意长度的部分读
+    def _recv_into(self, view):
+        got = self.conn.recv_into(view)
+        if got == len(view):
+            return True
+        if got == 0:
+            return False
+        while got < len(view):
+            n = self.conn.recv_into(view[got:])
+            if n == 0:
+                return False
+            got += n
+        return True
+
+    # 返回容量至少为 size 的缓冲区；扩容时换新对象而不原地 resize，
+    # 调用方手里尚未用完的旧 memoryview 因此依然有效
+    def _ensure(self, buf, size, keep=0):
+        if len(buf) >= size:
+            return buf
+        grown = bytearray(max(size, 2 * len(buf)))
+        grown[:keep] = buf[:keep]
+        return grown
+
+    def _track_seq(self, channel, seq):
+        expected = self.next_seq.get(channel)
+        if expected is not None and seq != expected:
+            self.lost[channel] = self.lost.get(channel, 0) + ((seq - expected) & 0xFFFFFFFF)
+        self.next_seq[channel] = (seq + 1) & 0xFFFFFFFF
+
+    def _fail(self, message):
+        print(message)
+        self.running = False
+        return None
+
+    # 读取并解析一个帧头，返回 (tag, channel, seq, ts, flags, 长度)
+    def _read_header(self):
+        head = memoryview(self.header_buf)
+        # 协议已知为 v2 时整个帧头一次读完，少一次系统调用
+        got = WIRE_HEADER.size if self.protocol == 2 else 5
+        if not self._recv_into(head[:got]):
+            return self._fail("[StreamClient] 警告: 接收到空头，可能连接已丢失。停止流。")
+
+        if self.protocol is None:
+            self.protocol = 2 if head[:2] == WIRE_MAGIC else 1
+            print(f"[StreamClient] 检测到设备端协议版本: {self.protocol}")
+            # 旧设备把一次 recv 读到的内容当作一条命令，与摄像头命令粘在一起会使后者丢失；
+            # 只向 v2 设备协商音频格式，旧设备沿用默认格式
+            if self.protocol == 2:
+                self.send_command(AUDIO_REQUEST)
+
+        if self.protocol == 2:
+            if not self._recv_into(head[got:WIRE_HEADER.size]):
+                return self._fail("[StreamClient] 警告: 接收到不完整的帧头，可能连接已丢失。停止流。")
+            magic, version, channel, flags, seq, ts_us, data_len = WIRE_HEADER.unpack_from(self.header_buf)
+            if magic != WIRE_MAGIC:
+                return self._fail(f"[StreamClient] 警告: 帧头魔数错误: {magic!r}。连接可能已损坏。停止流。")
+            self._track_seq(channel, seq)
+            tag = CHANNEL_TAGS.get(channel, b"?????")
+            if channel == CH_VIDEO and flags & FLAG_KEEPALIVE:
+                tag = b"KEEPA"
+            return tag, channel, seq, ts_us / 1000000.0, flags, data_len
+
+        if not self._recv_into(head[5:9]):
+            return self._fail("[StreamClient] 警告: 接收到不完整的长度字节，可能连接已丢失。停止流。")
+        tag = bytes(head[:5])
+        flags = FLAG_KEEPALIVE if tag == b"KEEPA" else 0
+        return tag, TAG_CHANNELS.get(tag, 0), None, None, flags, int.from_bytes(head[5:9], 'big')
+
+    # 读取一条完整消息。负载直接 recv_into 到复用的缓冲区，返回其 memoryview，
+    # 可直接交给 np.frombuffer / cv2.imdecode；它在下一次 read_message 前有效，
+    # 需要保留的调用方自行 bytes() 拷贝。v2 分片直接收进按通道复用的重组缓冲区
+    def read_message(self):
         if not self.conn or not self.running:
-            return None, None
+            return None
         try:
-            header = self.conn.recv(5)
-            if not header:
-                print("[StreamClient] 警告: 接收到空头，可能连接已丢失。停止流。")
-                self.running = False
-                return None, None
-
-            length_bytes = self.conn.recv(4)
-            if not length_bytes or len(length_bytes) < 4:
-                print("[StreamClient] 警告: 接收到不完整的长度字节，可能连接已丢失。停止流。")
-                self.running = False
-                return None, None
-
-            data_len = int.from_bytes(length_bytes, byteorder='big')
-
-            if data_len <= 0 or data_len > (1024 * 1024 * 5):
-                print(f"[StreamClient] 警告: 接收到的数据长度无效: {data_len}。连接可能已损坏。停止流。")
-                self.running = False
-                return None, None
-
-            data = b''
-            bytes_received = 0
-            while bytes_received < data_len:
-                packet = self.conn.recv(min(4096, data_len - bytes_received))
-                if not packet:
-                    print(f"[StreamClient] 错误: 数据接收不完整，接收 {bytes_received}/{data_len} 字节。连接丢失。停止流。")
-                    self.running = False
-                    return None, None
-                data += packet
-                bytes_received += len(packet)
-            return header, data
+            while True:
+                header = self._read_header()
+                if header is None:
+                    return None
+                tag, channel, seq, ts, flags, data_len = header
+                if data_len <= 0 or data_len > MAX_PAYLOAD:
+                    return self._fail(f"[StreamClient] 警告: 接收到的数据长度无效: {data_len}。连接可能已损坏。停止流。")
+
+                pending = self.partial.get(channel)
+                if pending is None and not flags & FLAG_MORE:
+                    self.buffer = self._ensure(self.buffer, data_len)
+                    view = memoryview(self.buffer)[:data_len]
+                    if not self._recv_into(view):
+                        return self._fail(f"[StreamClient] 错误: 数据接收不完整，预期 {data_len} 字节。连接丢失。停止流。")
+                    return StreamMessage(tag, channel, seq, ts, flags, view)
+
+                first, pos = pending if pending else (StreamMessage(tag, channel, seq, ts, flags, None), 0)
+                if pos + data_len > MAX_PAYLOAD:
+                    return self._fail(f"[StreamClient] 警告: 分片重组后长度超限: {pos + data_len}。停止流。")
+                assembly = self._ensure(self.assembly.get(channel, bytearray()), pos + data_len, keep=pos)
+                self.assembly[channel] = assembly
+                if not self._recv_into(memoryview(assembly)[pos:pos + data_len]):
+                    return self._fail(f"[StreamClient] 错误: 分片接收不完整，预期 {data_len} 字节。连接丢失。停止流。")
+                pos += data_len
+                if flags & FLAG_MORE:
+                    self.partial[channel] = (first, pos)
+                    continue
+                self.partial.pop(channel, None)
+                return first._replace(flags=flags, payload=memoryview(assembly)[:pos])
         except BrokenPipeError:
-            print("[StreamClient] 读取流: 连接中断 (BrokenPipeError)。停止流。")
-            self.running = False
-            return None, None
+            return self._fail("[StreamClient] 读取流: 连接中断 (BrokenPipeError)。停止流。")
         except socket.timeout:
-            print("[StreamClient] 读取流: 套接字超时期间接收数据。停止流。")
-            self.running = False
-            return None, None
+            return self._fail("[StreamClient] 读取流: 套接字超时期间接收数据。停止流。")
         except Exception as e:
-            print(f"[StreamClient] 读取流: 读取数据时出错: {e}. 停止流。")
-            self.running = False
-            return None, None
+            return self._fail(f"[StreamClient] 读取流: 读取数据时出错: {e}. 停止流。")
 
 # ==============================================================================
 # MonitoringApp 类 (主监控应用，统一版)
@@ -203,7 +1494,7 @@ class MonitoringApp:
         self.root.title("统一监控客户端")
         self.root.geometry("800x600")
 
-        self.last_frame = None  # 用于人脸模板捕捉的最后一帧
+        self.last_jpeg = None  # 最后收到的一帧 JPEG，录入人脸模板时再解码
 
         # 初始化 _after_id，确保它始终存在
         self._after_id = ''
@@ -229,6 +1520,14 @@ class MonitoringApp:
 
         self.client = None
         self.updater_thread = None
+        self.stage_threads = []
+        self.display_box = None   # 视频标签的 (宽, 高)，由 <Configure> 事件更新，解码阶段据此选缩小倍数
+        self.ui_calls = deque()   # 工作线程请求在 Tk 线程执行的回调，由显示定时器统一执行
+        self.pending_display = deque()   # 等音频时钟的 (采集时间戳, RGB, 到达时间)，按时间戳排列
+        self.display_stats = {}
+        self.decode_factors = {}  # 缩小倍数 -> 帧数
+        self.queues = {}
+        self.stage_stats = {}
 
         main_frame = tk.Frame(root)
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -238,6 +1537,7 @@ class MonitoringApp:
 
         self.video_label = tk.Label(video_frame, text="等待视频…", bg="black", fg="white", font=("Helvetica", 16))
         self.video_label.pack(fill=tk.BOTH, expand=True)
+        self.video_label.bind("<Configure>", self._on_video_resize)
 
         control_frame = tk.Frame(main_frame, bd=2, relief=tk.GROOVE)
         control_frame.pack(fill=tk.X, pady=5)
@@ -253,6 +1553,14 @@ class MonitoringApp:
         self.camera_option_menu = tk.OptionMenu(control_frame, self.camera_selector, *["/dev/video0", "/dev/video2"], command=self.switch_camera)
         self.camera_option_menu.pack(side=tk.LEFT, padx=5, pady=2)
 
+        # 下次开始监控时生效
+        self.motion_recording = tk.BooleanVar(value=RECORD_MODE == "motion")
+        tk.Checkbutton(control_frame, text="仅录制活动", variable=self.motion_recording).pack(side=tk.LEFT, padx=5, pady=2)
+
+        # 设备端码率控制器当前工作点
+        self.link_state_label = tk.Label(control_frame, text="", fg="#607D8B")
+        self.link_state_label.pack(side=tk.RIGHT, padx=5, pady=2)
+
         button_frame = tk.Frame(root, bd=2, relief=tk.GROOVE)
         button_frame.pack(fill=tk.X, pady=5)
 
@@ -266,6 +1574,28 @@ class MonitoringApp:
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+        self.catalog = RecordingCatalog("./records")
+        self.retention_thread = threading.Thread(target=self.retention_loop, daemon=True)
+        self.retention_thread.start()
+
+    # 后台按配额和保留天数清理录像分段，不清理正在写入的分段
+    def retention_loop(self):
+        while True:
+            try:
+                client = self.client
+                writer = client.writer if client else None
+                active = {writer.path} if writer and writer.path else set()
+                removed = enforce_retention("./records", active=active) if os.path.isdir("./records") else []
+                if removed:
+                    print(f"[MonitoringApp] 录像保留策略删除了 {len(removed)} 个分段: {removed}")
+                # 登记目录中尚未编目的录像（旧录像、异常退出未回调的分段），并清掉已删除的
+                added = self.catalog.sync(active)
+                if added:
+                    print(f"[MonitoringApp] 录像目录新登记 {added} 段录像")
+            except Exception as e:
+                print(f"[MonitoringApp] 录像保留策略执行出错: {e}")
+            time.sleep(RETENTION_CHECK_SECONDS)
+
     def on_closing(self):
         print("[MonitoringApp] 正在关闭应用程序...")
         self.stop_stream()
@@ -373,7 +1703,8 @@ class MonitoringApp:
             return
 
         ip, port = self.devices[dev_name]
-        self.client = StreamClient(ip, port)
+        self.client = StreamClient(ip, port, on_segment_closed=self.catalog.add,
+                                   record_mode="motion" if self.motion_recording.get() else "continuous")
         try:
             self.client.start()
             print(f"[MonitoringApp] StreamClient 为 {ip}:{port} 启动成功。")
@@ -397,12 +1728,28 @@ class MonitoringApp:
             self.client = None
             return
 
+        self.queues = {"decode": StageQueue("decode", CLIENT_DECODE_QUEUE),
+                       "display": StageQueue("display", 1),
+                       "record": StageQueue("record", CLIENT_RECORD_QUEUE)}
+        self.stage_stats = {name: {"count": 0, "busy": 0.0} for name in ("receive", "decode", "display", "record")}
+        self.stage_threads = [threading.Thread(target=stage, args=(self.client,), daemon=True)
+                              for stage in (self.decode_stage, self.record_stage)]
+        for t in self.stage_threads:
+            t.start()
+        self.pending_display.clear()
+        self.display_stats = {"ticks": 0, "late": 0.0, "late_max": 0.0, "backlog_max": 0, "replaced": 0, "due": None}
+        self._after_id = self.root.after(1000 // DISPLAY_REFRESH_HZ, self._render_tick)
         self.updater_thread = threading.Thread(target=self.update_loop, daemon=True)
         self.updater_thread.start()
         print("[MonitoringApp] 数据更新线程已启动。")
 
     def stop_stream(self):
         if self.client:
+            # 先让各阶段线程退出，录像线程写完队列中剩余的音视频后再释放写入器
+            self.client.running = False
+            for t in self.stage_threads:
+                t.join(timeout=CLIENT_STOP_TIMEOUT)
+            self.stage_threads = []
             self.client.stop()
             self.client = None
             print("[MonitoringApp] 监控流已停止。")
@@ -419,62 +1766,229 @@ class MonitoringApp:
 
         self.video_label.config(image='')
         self.video_label.configure(text="等待视频…")
+        self.link_state_label.config(text="")
 
+    # 接收/分发阶段：只做读 socket 和分发，不做任何可能阻塞的工作
     def update_loop(self):
-        frame_counter = 0
-        while self.client and self.client.running:
-            header, data = self.client.read_stream()
+        client = self.client
+        stats = self.stage_stats["receive"]
+        last_report = time.time()
+        while client.running:
+            msg = client.read_message()
+            header, data = (msg.tag, msg.payload) if msg else (None, None)
             if header is None:
-                print(f"[MonitoringApp] 没有有效数据或连接丢失 (header is None)，停止更新循环。总帧数: {frame_counter}。")
-                self.root.after(0, self.stop_stream)
+                print(f"[MonitoringApp] 没有有效数据或连接丢失 (header is None)，停止更新循环。总帧数: {stats['count']}。")
+                self._post(lambda: self.stop_stream() if self.client is client else None)
                 break
 
+            t0 = time.perf_counter()
+            # 旧协议没有采集时间戳：视频按到达时间计，录像补帧和活动索引用同一个时间
+            ts = msg.ts if msg.ts is not None else time.time()
             if header == b"VIDEO":
-                try:
-                    frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
-                    if frame is not None:
-                        frame_counter += 1
-                        img_height, img_width = frame.shape[:2]
-                        lbl_width = self.video_label.winfo_width()
-                        lbl_height = self.video_label.winfo_height()
-
-                        if lbl_width == 1 or lbl_height == 1:
-                            continue
-
-                        aspect_ratio = img_width / img_height
-                        if lbl_width / lbl_height > aspect_ratio:
-                            new_height = lbl_height
-                            new_width = int(lbl_height * aspect_ratio)
-                        else:
-                            new_width = lbl_width
-                            new_height = int(lbl_width / aspect_ratio)
-
-                        display_frame = cv2.resize(frame, (new_width, new_height))
-                        rgb_frame_for_display = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
-                        imgtk = ImageTk.PhotoImage(image=Image.fromarray(rgb_frame_for_display))
-
-                        self._after_id = self.root.after(0, lambda img=imgtk: self._update_video_label(img))
-
-                        frame_for_writer = cv2.resize(frame, (RECORDING_WIDTH, RECORDING_HEIGHT))
-                        self.last_frame = frame_for_writer.copy()
-
-                        if self.client.writer and self.client.writer.isOpened():
-                            self.client.writer.write(frame_for_writer)
-                        else:
-                            print("[MonitoringApp] 警告: 视频写入器未打开或已关闭，跳过帧写入。")
-                    else:
-                        print("[MonitoringApp] 警告: 视频帧解码失败 (frame is None)。")
-                except Exception as e:
-                    print(f"[MonitoringApp] 视频帧处理错误: {e}")
+                # data 是接收缓冲区的视图，入队前拷贝；录像直接保存这份 JPEG，不经过解码
+                jpeg = bytes(data)
+                self.last_jpeg = jpeg
+                if msg.flags & FLAG_ACTIVITY:
+                    self.queues["record"].put(("trigger", ts, None))
+                self.queues["decode"].put((ts, jpeg))
+                self.queues["record"].put(("video", ts, jpeg))
+                stats["count"] += 1
             elif header == b"AUDIO":
                 try:
-                    if self.client.audio_stream:
-                        self.client.audio_stream.write(data)
+                    pcm = client.decode_audio(data, msg.flags)
+                    if client.player:
+                        client.player.push(msg.ts, pcm)
+                    if RECORD_AUDIO:
+                        self.queues["record"].put(("audio", msg.ts, (pcm, client.audio_format)))
                 except Exception as e:
-                    print(f"[MonitoringApp] 音频播放错误: {e}")
+                    print(f"[MonitoringApp] 音频解码错误: {e}")
+            elif header == b"KEEPA":
+                # 设备端画面静止未发新帧：让录像重复上一帧，保证录像时间轴正确
+                if msg.flags & FLAG_ACTIVITY:
+                    self.queues["record"].put(("trigger", ts, None))
+                self.queues["record"].put(("video", ts, None))
+            elif header == b"STATE":
+                self.handle_device_state(data)
             else:
                 print(f"[MonitoringApp] 警告: 接收到未知头: {header.decode()}。")
-        print(f"[MonitoringApp] 数据更新线程已停止。最终帧数: {frame_counter}。")
+            stats["busy"] += time.perf_counter() - t0
+
+            if time.time() - last_report >= CLIENT_REPORT_INTERVAL:
+                self.report_pipeline(client, time.time() - last_report)
+                last_report = time.time()
+        if client.lost:
+            print(f"[MonitoringApp] 按通道统计的丢失消息数: {client.lost}")
+        print(f"[MonitoringApp] 数据更新线程已停止。最终帧数: {stats['count']}。")
+
+    def decode_stage(self, client):
+        stats = self.stage_stats["decode"]
+        meter = ActivityMeter()
+        while client.running:
+            item = self.queues["decode"].get()
+            if item is None:
+                continue
+            ts, jpeg = item
+            box = self.display_box
+            t0 = time.perf_counter()
+            # 录像直接保存 JPEG，解码只为显示和活动量：按标签尺寸选可用的最大缩小倍数，
+            # 标签尚未布局时活动量只需 1/8 解码
+            full = jpeg_dimensions(jpeg)
+            if box:
+                factor = reduced_decode_factor(full, fit_size(full, box) if full else None)
+            else:
+                factor = reduced_decode_factor(full, ACTIVITY_SIZE)
+            try:
+                frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), REDUCED_DECODE_FLAGS[factor])
+            except Exception as e:
+                print(f"[MonitoringApp] 视频帧解码错误: {e}")
+                frame = None
+            stats["busy"] += time.perf_counter() - t0
+            if frame is None:
+                print("[MonitoringApp] 警告: 视频帧解码失败 (frame is None)。")
+                continue
+            stats["count"] += 1
+            self.decode_factors[factor] = self.decode_factors.get(factor, 0) + 1
+            self.queues["record"].put(("activity", ts, meter.score(frame)))
+            if not box:
+                continue
+
+            # 缩放和颜色转换也在本线程做，Tk 线程只需生成 PhotoImage
+            t0 = time.perf_counter()
+            size = (frame.shape[1], frame.shape[0])
+            display_size = fit_size(size, box)
+            display_frame = frame if display_size == size else cv2.resize(frame, display_size)
+            self.queues["display"].put((ts, cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)))
+            stats["busy"] += time.perf_counter() - t0
+
+    # 工作线程不直接调用 Tk，把回调排队给 Tk 线程的显示定时器执行
+    def _post(self, fn):
+        self.ui_calls.append(fn)
+
+    def _on_video_resize(self, event):
+        if event.width > 1 and event.height > 1:
+            self.display_box = (event.width, event.height)
+
+    # Tk 线程上的显示定时器：最多每秒 DISPLAY_REFRESH_HZ 次，显示已到期帧中最新的一帧。
+    # 两次定时之间到期的多帧只显示最后一帧，Tk 落后时不会堆积回调
+    def _render_tick(self):
+        st = self.display_stats
+        now = time.perf_counter()
+        if st["due"] is not None:
+            late = max(0.0, now - st["due"])
+            st["ticks"] += 1
+            st["late"] += late
+            st["late_max"] = max(st["late_max"], late)
+        st["backlog_max"] = max(st["backlog_max"], len(self.ui_calls))
+        while self.ui_calls:
+            self.ui_calls.popleft()()
+        client = self.client
+        if client is None:
+            return
+
+        # 按音频时钟对齐：画面比正在播放的声音新时先留在缓冲里，后到的新帧不会顶掉已到期的帧。
+        # 等待超过 AV_SYNC_MAX_DELAY 的帧（音频时钟停滞）也视为到期
+        pending = self.pending_display
+        while True:
+            item = self.queues["display"].get(0)
+            if item is None:
+                break
+            if pending and item[0] is not None and pending[-1][0] is not None and item[0] < pending[-1][0]:
+                st["replaced"] += 1
+                continue
+            pending.append((item[0], item[1], now))
+            if len(pending) > DISPLAY_SYNC_FRAMES:
+                pending.popleft()
+                st["replaced"] += 1
+        player = client.player
+
+        def is_due(entry):
+            return not player or entry[0] is None or player.video_delay(entry[0]) <= 0 or \
+                now - entry[2] >= AV_SYNC_MAX_DELAY
+
+        due = None
+        while pending and is_due(pending[0]):
+            if due is not None:
+                st["replaced"] += 1
+            due = pending.popleft()
+        if due is not None:
+            ts, rgb, _ = due
+            t0 = time.perf_counter()
+            try:
+                self._update_video_label(ImageTk.PhotoImage(image=Image.fromarray(rgb)))
+                self.stage_stats["display"]["count"] += 1
+            except Exception as e:
+                print(f"[MonitoringApp] 视频帧显示错误: {e}")
+            self.stage_stats["display"]["busy"] += time.perf_counter() - t0
+
+        interval = 1000 // DISPLAY_REFRESH_HZ
+        st["due"] = time.perf_counter() + interval / 1000.0
+        self._after_id = self.root.after(interval, self._render_tick)
+
+    # 录像阶段：JPEG 原样封装进 AVI；视频块为 None 表示设备端保活，重复上一帧
+    def record_stage(self, client):
+        stats = self.stage_stats["record"]
+        queue = self.queues["record"]
+        # 停止后继续把队列写空，不丢最后几秒
+        while client.running or len(queue):
+            item = queue.get()
+            if item is None:
+                continue
+            kind, ts, data = item
+            writer = client.writer
+            if not writer or not writer.isOpened():
+                print("[MonitoringApp] 警告: 视频写入器未打开或已关闭，跳过帧写入。")
+                continue
+            t0 = time.perf_counter()
+            try:
+                if kind == "audio":
+                    writer.write_audio(data[0], data[1], ts)
+                elif kind == "activity":
+                    writer.write_activity(data, ts)
+                elif kind == "trigger":
+                    writer.trigger(ts)
+                else:
+                    writer.write_video(data, ts)
+                    stats["count"] += 1
+            except Exception as e:
+                print(f"[MonitoringApp] 录像写入错误: {e}")
+            stats["busy"] += time.perf_counter() - t0
+
+    def report_pipeline(self, client, elapsed):
+        rates = " ".join(f"{name}={st['count'] / elapsed:.1f}/s({st['busy'] / elapsed:.0%})"
+                         for name, st in self.stage_stats.items())
+        depths = " ".join(f"{q.name}={len(q)}/{q.maxsize}" for q in self.queues.values())
+        drops = " ".join(f"{q.name}={q.drops}" for q in self.queues.values())
+        print(f"[MonitoringApp] 流水线 吞吐 {rates}, 队列 {depths}, 丢弃 {drops}, "
+              f"解码倍数 {self.decode_factors}")
+        ds = self.display_stats
+        if ds.get("ticks"):
+            print(f"[MonitoringApp] 显示 {self.stage_stats['display']['count'] / elapsed:.1f} fps, "
+                  f"丢弃 {self.queues['display'].drops + ds['replaced']} 帧, "
+                  f"定时器延迟 平均 {ds['late'] / ds['ticks'] * 1000:.1f} ms / 最大 {ds['late_max'] * 1000:.1f} ms, "
+                  f"待执行回调最多 {ds['backlog_max']}")
+            ds.update(ticks=0, late=0.0, late_max=0.0, backlog_max=0)
+        if client.player:
+            print(f"[MonitoringApp] 抖动缓冲 {client.player.report()}")
+        if isinstance(client.writer, MotionRecorder):
+            print(f"[MonitoringApp] 活动录像 {client.writer.report()}")
+        for st in self.stage_stats.values():
+            st["count"] = 0
+            st["busy"] = 0.0
+
+    def handle_device_state(self, data):
+        try:
+            state = json.loads(bytes(data).decode("utf-8"))
+        except (ValueError, UnicodeDecodeError) as e:
+            print(f"[MonitoringApp] 警告: 设备状态解析失败: {e}")
+            return
+        if state.get("audio") and self.client:
+            self.client.set_audio_format(state["audio"])
+        rate = state.get("rate")
+        if rate:
+            text = (f"JPEG {rate['quality']} | {rate['scale']:.0%} | {rate['fps']} fps | "
+                    f"{rate['kbps']:.0f} kbps")
+            print(f"[MonitoringApp] 设备工作点: {rate}")
+            self._post(lambda: self.link_state_label.config(text=text))
 
     def _update_video_label(self, imgtk):
         if hasattr(self.video_label, 'winfo_exists') and self.video_label.winfo_exists():
@@ -490,15 +2004,23 @@ class MonitoringApp:
 
     # ---------- 录入/删除模板 ----------
     def capture_template(self):
-        if self.last_frame is None:
+        frame = None
+        if self.last_jpeg is not None:
+            jpeg = self.last_jpeg
+            full = jpeg_dimensions(jpeg)
+            factor = reduced_decode_factor(full, (RECORDING_WIDTH, RECORDING_HEIGHT))
+            frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), REDUCED_DECODE_FLAGS[factor])
+        if frame is None:
             messagebox.showwarning("提示", "没有可用的视频帧，请先开始监控。")
             return
+        if frame.shape[:2] != (RECORDING_HEIGHT, RECORDING_WIDTH):
+            frame = cv2.resize(frame, (RECORDING_WIDTH, RECORDING_HEIGHT))
 
         name = simpledialog.askstring("录入人脸", "请输入姓名：")
         if not name:
             return
 
-        ok, enc = cv2.imencode(".jpg", self.last_frame)
+        ok, enc = cv2.imencode(".jpg", frame)
         if not ok:
             messagebox.showerror("编码失败", "无法编码当前帧为 JPG。")
             return
@@ -557,16 +2079,18 @@ class MonitoringApp:
 
     # ---------- 历史视频 ----------
     def view_history(self):
-        history_path = "./records"
-        os.makedirs(history_path, exist_ok=True)
-
-        files = sorted([f for f in os.listdir(history_path) if f.endswith((".avi", ".mp4"))], reverse=True)
-        if not files:
-            messagebox.showinfo("提示", "没有历史录像")
+        total = self.catalog.count()
+        if not total:
+            messagebox.showinfo("提示", "没有历史录像（新录像会在后台编目后出现）")
             return
 
         win = tk.Toplevel(self.root)
         win.title("历史记录")
+        win.geometry("720x600")
+
+        nav = tk.Frame(win)
+        nav.pack(side=tk.BOTTOM, fill=tk.X, pady=5)
+        page_label = tk.Label(nav, text="")
 
         canvas = tk.Canvas(win)
         scrollbar = tk.Scrollbar(win, orient="vertical", command=canvas.yview)
@@ -584,15 +2108,65 @@ class MonitoringApp:
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
-        for f in files:
-            tk.Button(scrollable_frame, text=f, command=lambda fp=f: self.play_video(fp), padx=5, pady=2).pack(fill=tk.X, pady=2)
+        state = {"offset": 0, "total": total}
+
+        # 只查询并解码当前页的记录和缩略图
+        def show_page():
+            for child in scrollable_frame.winfo_children():
+                child.destroy()
+            win.thumbs = []
+            state["total"] = self.catalog.count()
+            for name, start, end, duration, frames, width, height, size in self.catalog.page(state["offset"]):
+                row = tk.Frame(scrollable_frame, pady=2)
+                row.pack(fill=tk.X)
+                for jpeg in self.catalog.thumbnails(name):
+                    thumb = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    if thumb is None:
+                        continue
+                    imgtk = ImageTk.PhotoImage(image=Image.fromarray(cv2.cvtColor(thumb, cv2.COLOR_BGR2RGB)))
+                    win.thumbs.append(imgtk)
+                    tk.Label(row, image=imgtk).pack(side=tk.LEFT, padx=1)
+                started = datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S")
+                info = (f"{name}\n{started}  时长 {datetime.timedelta(seconds=int(duration))}\n"
+                        f"{width}x{height}  {frames} 帧  {size / 1024 / 1024:.1f} MB")
+                tk.Button(row, text=info, justify=tk.LEFT, anchor="w",
+                          command=lambda fp=name: self.play_video(fp)).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+            pages = max(1, (state["total"] + CATALOG_PAGE_SIZE - 1) // CATALOG_PAGE_SIZE)
+            page_label.config(text=f"第 {state['offset'] // CATALOG_PAGE_SIZE + 1} / {pages} 页，共 {state['total']} 段")
+            canvas.yview_moveto(0)
+
+        def move(delta):
+            offset = state["offset"] + delta * CATALOG_PAGE_SIZE
+            if 0 <= offset < state["total"]:
+                state["offset"] = offset
+                show_page()
+
+        # 按采集时间定位：只读各分段索引头部，打开命中的那一段并从对应帧开始播放
+        def goto_time():
+            text = simpledialog.askstring("按时间查找", "时间（YYYY-MM-DD HH:MM:SS）：", parent=win,
+                                          initialvalue=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            if not text:
+                return
+            try:
+                ts = time.mktime(datetime.datetime.strptime(text.strip(), "%Y-%m-%d %H:%M:%S").timetuple())
+            except ValueError:
+                messagebox.showerror("格式错误", "请按 YYYY-MM-DD HH:MM:SS 输入时间。", parent=win)
+                return
+            found = find_segment("./records", ts)
+            if found is None:
+                messagebox.showinfo("提示", f"{text} 没有录像。", parent=win)
+                return
+            path, frame = found
+            self.play_video(os.path.basename(path), start_frame=frame)
 
-        win.update_idletasks()
-        win_width = win.winfo_reqwidth()
-        win_height = min(win.winfo_reqheight(), 600)
-        win.geometry(f"{win_width}x{win_height}")
+        tk.Button(nav, text="上一页", command=lambda: move(-1)).pack(side=tk.LEFT, padx=5)
+        tk.Button(nav, text="下一页", command=lambda: move(1)).pack(side=tk.LEFT, padx=5)
+        page_label.pack(side=tk.LEFT, padx=10)
+        tk.Button(nav, text="按时间查找", command=goto_time).pack(side=tk.RIGHT, padx=5)
 
-    def play_video(self, fname):
+        show_page()
+
+    def play_video(self, fname, start_frame=0):
         win = tk.Toplevel(self.root)
         win.title(f"播放: {fname}")
         win.geometry("700x550")
@@ -625,7 +2199,7 @@ class MonitoringApp:
             win.destroy()
             return
 
-        cap = cv2.VideoCapture(video_path)
+        cap = open_recording(video_path)
         if not cap.isOpened():
             print(f"[MonitoringApp] 警告: 无法打开视频文件 {fname}，检查文件编码或路径。")
             messagebox.showerror("播放错误", f"无法打开视频文件: {fname}。可能编码不兼容，请检查或重新录制。")
@@ -637,7 +2211,53 @@ class MonitoringApp:
         print(f"[MonitoringApp] 使用录制帧率 {fps} FPS 播放 {fname}。")
         delay = int(1000 / fps)
 
-        state = {"paused": False, "current_frame": 0, "playing": True}
+        engine = PlaybackEngine(cap, total_frames)
+        lbl.bind("<Configure>", lambda e: engine.resize((e.width, e.height)) if e.width > 1 and e.height > 1 else None)
+
+        state = {"paused": False, "current_frame": 0, "playing": True, "progress": 0, "speed": 0,
+                 "only_active": tk.BooleanVar(value=False)}
+        if start_frame:
+            state["current_frame"] = min(start_frame, max(total_frames - 1, 0))
+            engine.seek(state["current_frame"])
+
+        # 活动时间轴：只读 .act 索引，不扫描视频
+        activity = load_activity(video_path)
+        timeline = None
+        if activity is not None and len(activity):
+            act_frame = tk.Frame(win)
+            act_frame.pack(fill=tk.X, pady=(0, 5))
+            timeline = tk.Canvas(act_frame, height=24, bg="#263238", highlightthickness=0)
+            timeline.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+
+            def draw_timeline(event=None):
+                timeline.delete("bar")
+                width = max(1, timeline.winfo_width())
+                seconds = len(activity)
+                for sec in np.flatnonzero(activity):
+                    level = min(1.0, activity[sec] / 2000.0)
+                    color = "#FFC107" if activity[sec] >= ACTIVITY_THRESHOLD else "#546E7A"
+                    x0, x1 = sec * width / seconds, max(sec * width / seconds + 1, (sec + 1) * width / seconds)
+                    timeline.create_rectangle(x0, 24 - max(2, 22 * level), x1, 24, fill=color, width=0, tags="bar")
+                timeline.tag_raise("cursor")
+
+            def on_timeline_click(event):
+                width = max(1, timeline.winfo_width())
+                seek(int(event.x / width * len(activity) * fps))
+
+            timeline.create_line(0, 0, 0, 24, fill="white", tags="cursor")
+            timeline.bind("<Configure>", draw_timeline)
+            timeline.bind("<Button-1>", on_timeline_click)
+
+            # 跳转后播放位置停在活动前 ACTIVITY_PAD_SECONDS 秒，从其后开始找，再按一次才到下一段
+            def jump_to_next_activity():
+                sec = next_activity(activity, int(state["current_frame"] / fps) + ACTIVITY_PAD_SECONDS + 1)
+                if sec is None:
+                    messagebox.showinfo("提示", "后面没有活动了。")
+                else:
+                    seek(max(0, sec - ACTIVITY_PAD_SECONDS) * fps)
+
+            tk.Button(act_frame, text="下一段活动", command=jump_to_next_activity).pack(side=tk.LEFT, padx=5)
+            tk.Checkbutton(act_frame, text="只播放活动片段", variable=state["only_active"]).pack(side=tk.LEFT, padx=5)
         _after_id_play = None
 
         def update_time_display():
@@ -650,6 +2270,13 @@ class MonitoringApp:
             if state["playing"]:
                 win.after(1000, update_time_display)
 
+        def seek(frame):
+            state["current_frame"] = min(max(0, frame), max(total_frames - 1, 0))
+            engine.seek(state["current_frame"])
+            if state["paused"]:
+                # 暂停时定位后等预取到新位置的帧再刷新一次画面
+                win.after(100, lambda: show_frame() or None)
+
         def toggle_pause():
             state["paused"] = not state["paused"]
             pause_btn.config(text="继续" if state["paused"] else "暂停")
@@ -657,79 +2284,70 @@ class MonitoringApp:
                 update_frame()
 
         def fast_forward():
-            if not cap.isOpened() or not state["playing"]: return
-            state["current_frame"] = min(total_frames - 1, state["current_frame"] + int(fps * 10))
-            cap.set(cv2.CAP_PROP_POS_FRAMES, state["current_frame"])
-            update_frame()
+            if not state["playing"]: return
+            seek(state["current_frame"] + int(fps * 10))
 
         def rewind():
-            if not cap.isOpened() or not state["playing"]: return
-            state["current_frame"] = max(0, state["current_frame"] - int(fps * 10))
-            cap.set(cv2.CAP_PROP_POS_FRAMES, state["current_frame"])
-            update_frame()
+            if not state["playing"]: return
+            seek(state["current_frame"] - int(fps * 10))
+
+        def change_speed():
+            state["speed"] = (state["speed"] + 1) % len(PLAYBACK_SPEEDS)
+            speed = PLAYBACK_SPEEDS[state["speed"]]
+            speed_btn.config(text=f"{speed}x")
+            engine.set_speed(speed, state["current_frame"])
 
         def on_progress(val, from_scale=False):
-            if not cap.isOpened() or not state["playing"]: return
-            if from_scale:
-                target_frame = int(float(val) / 100 * total_frames)
-                state["current_frame"] = target_frame
-                cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
-                update_frame()
+            if not state["playing"] or not total_frames: return
+            # 播放时 progress.set() 也会触发回调，只有用户拖动（值与上次设置的不同）才定位
+            if from_scale and int(float(val)) != state["progress"]:
+                state["progress"] = int(float(val))
+                seek(int(float(val) / 100 * total_frames))
+
+        # 从预取缓冲取一帧显示；缓冲暂时为空时返回 False
+        def show_frame():
+            item = engine.pull()
+            if item is None:
+                return False
+            n, rgb = item
+            state["current_frame"] = n + 1
+            if timeline is not None:
+                x = state["current_frame"] / float(max(total_frames, 1)) * timeline.winfo_width()
+                timeline.coords("cursor", x, 0, x, 24)
+            imgtk = ImageTk.PhotoImage(image=Image.fromarray(rgb))
+            lbl.imgtk = imgtk
+            lbl.config(image=imgtk)
+            pct = int(state["current_frame"] * 100 / total_frames) if total_frames else 0
+            if pct != state["progress"]:
+                state["progress"] = pct
+                progress.set(pct)
+            return True
 
         def update_frame():
             nonlocal _after_id_play
-            if not state["playing"]:
-                if _after_id_play != '':
-                    try:
-                        win.after_cancel(_after_id_play)
-                    except ValueError:
-                        pass
+            if not state["playing"] or state["paused"]:
                 return
-
-            if not state["paused"]:
-                cap.set(cv2.CAP_PROP_POS_FRAMES, state["current_frame"])
-                ret, frame = cap.read()
-                if ret:
-                    state["current_frame"] += 1
-
-                    img_height, img_width = frame.shape[:2]
-                    lbl_width = lbl.winfo_width()
-                    lbl_height = lbl.winfo_height()
-
-                    if lbl_width == 1 or lbl_height == 1:
-                        _after_id_play = win.after(delay, update_frame)
-                        return
-
-                    aspect_ratio = img_width / img_height
-                    if lbl_width / lbl_height > aspect_ratio:
-                        new_height = lbl_height
-                        new_width = int(lbl_height * aspect_ratio)
+            shown = show_frame()
+            if shown and timeline is not None and state["only_active"].get():
+                # 进入无活动的一秒时直接跳到下一段活动（含前置 ACTIVITY_PAD_SECONDS 秒）
+                sec = int(state["current_frame"] / fps)
+                if sec < len(activity) and activity[sec] < ACTIVITY_THRESHOLD and \
+                        not (activity[sec:sec + ACTIVITY_PAD_SECONDS + 1] >= ACTIVITY_THRESHOLD).any():
+                    nxt = next_activity(activity, sec)
+                    if nxt is None:
+                        engine.seek(total_frames)
                     else:
-                        new_width = lbl_width
-                        new_height = int(lbl_width / aspect_ratio)
-
-                    display_frame = cv2.resize(frame, (new_width, new_height))
-                    display_frame = cv2.cvtColor(display_frame, cv2.COLOR_BGR2RGB)
-                    imgtk = ImageTk.PhotoImage(image=Image.fromarray(display_frame))
-                    lbl.imgtk = imgtk
-                    lbl.config(image=imgtk)
-
-                    if not progress.get() == int(state["current_frame"] * 100 / total_frames):
-                        progress.set(int(state["current_frame"] * 100 / total_frames))
-                else:
-                    print(f"[MonitoringApp] 视频 {fname} 播放结束，帧读取失败。")
-                    state["playing"] = False
-                    cap.release()
-                    messagebox.showinfo("播放完成", f"视频 {fname} 播放完毕。")
-                    if _after_id_play != '':
-                        try:
-                            win.after_cancel(_after_id_play)
-                        except ValueError:
-                            pass
-                    return
-
+                        seek(max(sec + 1, nxt - ACTIVITY_PAD_SECONDS) * fps)
+            if not shown and engine.finished():
+                print(f"[MonitoringApp] 视频 {fname} 播放结束。")
+                state["playing"] = False
+                engine.close()
+                messagebox.showinfo("播放完成", f"视频 {fname} 播放完毕。")
+                return
             _after_id_play = win.after(delay, update_frame)
 
+        speed_btn = tk.Button(ctrl_frame, text="1x", bg="#9C27B0", fg="white", command=change_speed)
+        speed_btn.pack(side=tk.LEFT, padx=5, before=time_label)
         pause_btn.config(command=toggle_pause)
         fast_forward_btn.config(command=fast_forward)
         rewind_btn.config(command=rewind)
@@ -738,18 +2356,72 @@ class MonitoringApp:
         update_frame()
 
         def on_win_close_play():
-            state["playing"] = False
-            if _after_id_play != '':
+            if _after_id_play:
                 try:
                     win.after_cancel(_after_id_play)
                 except ValueError:
                     pass
-            cap.release()
+            if state["playing"]:
+                state["playing"] = False
+                engine.close()
             win.destroy()
         win.protocol("WM_DELETE_WINDOW", on_win_close_play)
 
+# ==============================================================================
+# 基准测试：python3 client_new7.py bench-recv
+# 本机 socketpair 回环上按不同帧大小收发，对比旧的 recv(4096) + "data +=" 读法
+# 与 recv_into 复用缓冲区读法的吞吐
+# ==============================================================================
+def _legacy_read(conn):
+    header = conn.recv(5)
+    if not header:
+        return None
+    rest = conn.recv(WIRE_HEADER.size - 5)
+    data_len = WIRE_HEADER.unpack(header + rest)[-1]
+    data = b''
+    while len(data) < data_len:
+        packet = conn.recv(min(4096, data_len - len(data)))
+        if not packet:
+            return None
+        data += packet
+    return data
+
+def bench_recv(sizes=(4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024), total=64 * 1024 * 1024):
+    print(f"{'帧大小(KB)':>10} {'旧读法(MB/s)':>14} {'recv_into(MB/s)':>16} {'加速':>6}")
+    for size in sizes:
+        count = max(20, total // size)
+        payload = bytes(size)
+        frame = WIRE_HEADER.pack(WIRE_MAGIC, 2, CH_VIDEO, 0, 0, 0, size) + payload
+
+        def run(reader):
+            a, b = socket.socketpair()
+            sender = threading.Thread(target=lambda: [a.sendall(frame) for _ in range(count)], daemon=True)
+            t0 = time.perf_counter()
+            sender.start()
+            for _ in range(count):
+                reader(b)
+            elapsed = time.perf_counter() - t0
+            sender.join()
+            a.close()
+            b.close()
+            return size * count / elapsed / 1e6
+
+        legacy = run(_legacy_read)
+        client = StreamClient("127.0.0.1", 0)
+        client.running = True
+
+        def zero_copy(conn):
+            client.conn = conn
+            return client.read_message()
+
+        fast = run(zero_copy)
+        print(f"{size // 1024:>10} {legacy:>14.1f} {fast:>16.1f} {fast / legacy:>5.1f}x")
+
 # ---------- main ----------
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-recv":
+        bench_recv()
+        sys.exit(0)
     root = tk.Tk()
     app = MonitoringApp(root)
     root.mainloop()
\ No newline at end of file
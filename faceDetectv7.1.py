@@ -3,10 +3,65 @@ import socket
 import time
 import struct
 import threading
+import json
 import pyaudio
 import sys
 import os
+import multiprocessing
+import queue
 import numpy as np
+from collections import deque
+
+# ------------------------------------------------------------------------
+# 单帧预处理上下文：按需计算并缓存派生图像（灰度、缩小灰度、直方图均衡、
+# 裁剪缩放视图、各分析器的前景掩码），同一帧内所有分析器共享，
+# 帧处理完后 release() 释放
+# ------------------------------------------------------------------------
+class FrameContext:
+    def __init__(self, frame):
+        self.frame = frame
+        self._cache = {}
+
+    def _memo(self, key, fn):
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
+
+    @property
+    def gray(self):
+        return self._memo("gray", lambda: cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def equalized(self):
+        return self._memo("equalized", lambda: cv2.equalizeHist(self.gray))
+
+    def small_gray(self, scale):
+        return self._memo(("small_gray", scale), lambda: cv2.resize(
+            self.gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA))
+
+    # roi=(x, y, w, h) 裁剪后按 scale 缩放的 BGR 视图
+    def view(self, roi=None, scale=1.0):
+        def make():
+            img = self.frame
+            if roi is not None:
+                x, y, w, h = roi
+                img = img[y:y+h, x:x+w]
+            if scale != 1.0:
+                img = cv2.resize(img, None, fx=scale, fy=scale,
+                                 interpolation=cv2.INTER_AREA)
+            return img
+        return self._memo(("view", roi, scale), make)
+
+    # owner 需实现 foreground_mask(ctx)；每帧只计算一次，背景模型也只更新一次
+    def foreground(self, owner):
+        return self._memo(("fg", id(owner)), lambda: owner.foreground_mask(self))
+
+    def release(self):
+        self._cache.clear()
+        self.frame = None
+
+def as_context(frame):
+    return frame if isinstance(frame, FrameContext) else FrameContext(frame)
 
 # ------------------------------------------------------------------------
 # 快递箱计数器：每秒统计移动目标（快递箱）数量
@@ -26,6 +81,73 @@ import numpy as np
 # ------------------------------------------------------------------------
 # BoxCounter：适应低速移动箱子
 # ------------------------------------------------------------------------
+# ------------------------------------------------------------------------
+# 质心跟踪器：按质心距离把本帧检测关联到已有轨迹，分配稳定 ID。
+# 距离矩阵一次性向量化计算，再按距离从小到大贪心配对
+# ------------------------------------------------------------------------
+class CentroidTracker:
+    def __init__(self, max_distance=80, max_missed=5):
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.next_id = 0
+        self.ids = np.zeros(0, np.int64)
+        self.centroids = np.zeros((0, 2), np.float32)
+        self.missed = np.zeros(0, np.int32)
+        self.counted = np.zeros(0, bool)
+
+    # points 为 (N, 2) 质心数组；返回 (ids, prev)，prev 为各检测上一帧的质心，新轨迹为 NaN
+    def update(self, points):
+        points = np.asarray(points, np.float32).reshape(-1, 2)
+        n_t, n_d = len(self.centroids), len(points)
+        det_track = np.full(n_d, -1, np.int64)
+
+        if n_t and n_d:
+            d = np.linalg.norm(self.centroids[:, None, :] - points[None, :, :], axis=2)
+            order = np.argsort(d, axis=None)
+            order = order[d.flat[order] <= self.max_distance]
+            used_t = np.zeros(n_t, bool)
+            for flat in order:
+                t, j = divmod(int(flat), n_d)
+                if used_t[t] or det_track[j] >= 0:
+                    continue
+                used_t[t] = True
+                det_track[j] = t
+
+        prev = np.full((n_d, 2), np.nan, np.float32)
+        matched = det_track >= 0
+        prev[matched] = self.centroids[det_track[matched]]
+
+        # 已匹配轨迹更新位置，未匹配轨迹累计丢失帧数
+        missed = self.missed + 1
+        missed[det_track[matched]] = 0
+        centroids = self.centroids.copy()
+        centroids[det_track[matched]] = points[matched]
+        keep = missed <= self.max_missed
+
+        # 未匹配检测新建轨迹
+        n_new = int(np.count_nonzero(~matched))
+        new_ids = np.arange(self.next_id, self.next_id + n_new, dtype=np.int64)
+        self.next_id += n_new
+        ids = np.empty(n_d, np.int64)
+        ids[matched] = self.ids[det_track[matched]]
+        ids[~matched] = new_ids
+
+        # 新轨迹追加在末尾，记下检测在新数组里的位置
+        old_pos = np.cumsum(keep) - 1
+        det_pos = np.empty(n_d, np.int64)
+        det_pos[matched] = old_pos[det_track[matched]]
+        det_pos[~matched] = int(np.count_nonzero(keep)) + np.arange(n_new)
+
+        self.ids = np.concatenate([self.ids[keep], new_ids])
+        self.centroids = np.concatenate([centroids[keep], points[~matched]])
+        self.missed = np.concatenate([missed[keep], np.zeros(n_new, np.int32)])
+        self.counted = np.concatenate([self.counted[keep], np.zeros(n_new, bool)])
+        self.last_pos = det_pos
+        return ids, prev
+
+    def reset(self):
+        self.__init__(self.max_distance, self.max_missed)
+
 # ------------------------------------------------------------------------
 # 斜视三面箱计数器（检测多边形边数 5–8）
 # ------------------------------------------------------------------------
@@ -34,23 +156,47 @@ class BoxCounter:
                  history=500,
                  varThreshold=30,
                  min_area=2000,
-                 eps_coef=0.025):
+                 eps_coef=0.025,
+                 roi=None,
+                 scale=1.0,
+                 count_line=None,
+                 interval=1.0,
+                 max_distance=80):
         self.bgsub = cv2.createBackgroundSubtractorMOG2(
             history=history,
             varThreshold=varThreshold,
             detectShadows=False)
         self.min_area = min_area
         self.eps_coef = eps_coef
+        # 计数线 ((x1, y1), (x2, y2))，全帧坐标；None 时取 ROI/全帧的竖直中线。
+        # 每条轨迹的质心越过计数线时计数一次
+        self.count_line = count_line
+        self.interval = interval
+        self.tracker = CentroidTracker(max_distance=max_distance)
         self.start_time = time.time()
-        self.max_count = 0
-        self.kern = cv2.getStructuringElement(cv2.MORPH_RECT, (7,7))
+        self.total_count = 0      # 累计通过数量
+        self.interval_count = 0   # 当前统计周期内通过数量
+        self.rate = 0.0           # 上一统计周期的通过速率（个/秒）
+        # roi=(x, y, w, h) 为全帧坐标下的传送带区域，None 表示全帧；
+        # scale<1 时在缩小后的 ROI 上做前景分割与形态学
+        self.roi = roi
+        self.scale = scale
+        k = max(3, int(7 * scale) | 1)
+        self.kern = cv2.getStructuringElement(cv2.MORPH_RECT, (k, k))
+        self.proc_min_area = min_area * scale * scale
+        self.polys, self.ids = [], []
 
-    def process(self, frame):
+    # 处理坐标系下的前景掩码，经 FrameContext.foreground() 调用，供运动门控复用
+    def foreground_mask(self, ctx):
         # 前景分割 + 二值化
-        fg = self.bgsub.apply(frame)
+        fg = self.bgsub.apply(ctx.view(self.roi, self.scale))
         _, th = cv2.threshold(fg, 180, 255, cv2.THRESH_BINARY)
         clean = cv2.morphologyEx(th, cv2.MORPH_OPEN, self.kern, iterations=2)
-        clean = cv2.morphologyEx(clean, cv2.MORPH_CLOSE, self.kern, iterations=2)
+        return cv2.morphologyEx(clean, cv2.MORPH_CLOSE, self.kern, iterations=2)
+
+    # 返回全帧坐标下的多边形列表；frame 可以是图像或 FrameContext
+    def detect(self, frame):
+        clean = as_context(frame).foreground(self)
 
         # 查轮廓（兼容 OpenCV3/4）
         cnts = cv2.findContours(clean, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -59,7 +205,7 @@ class BoxCounter:
         valid = []
         for cnt in contours:
             area = cv2.contourArea(cnt)
-            if area < self.min_area:
+            if area < self.proc_min_area:
                 continue
 
             peri = cv2.arcLength(cnt, True)
@@ -69,23 +215,190 @@ class BoxCounter:
             if 5 <= len(approx) <= 8 and cv2.isContourConvex(approx):
                 valid.append(approx)
 
-        # 在帧上画多边形
-        for poly in valid:
-            cv2.polylines(frame, [poly], True, (255, 0, 0), 2)
+        # 映射回全帧坐标
+        if self.scale != 1.0 or self.roi is not None:
+            ox, oy = (self.roi[0], self.roi[1]) if self.roi is not None else (0, 0)
+            offset = np.array([ox, oy], np.float32)
+            valid = [np.round(poly.astype(np.float32) / self.scale + offset).astype(np.int32)
+                     for poly in valid]
+        return valid
+
+    def _line(self, frame):
+        if self.count_line is None:
+            x, y, w, h = self.roi if self.roi is not None else \
+                (0, 0, frame.shape[1], frame.shape[0])
+            self.count_line = ((x + w // 2, y), (x + w // 2, y + h))
+        return self.count_line
+
+    # 更新轨迹并统计越线次数，返回本帧新增计数与各检测的轨迹 ID
+    def track(self, polys, line):
+        if polys:
+            points = np.array([p.reshape(-1, 2).mean(axis=0) for p in polys], np.float32)
+        else:
+            points = np.zeros((0, 2), np.float32)
+        ids, prev = self.tracker.update(points)
+        if not len(points):
+            return 0, ids
+
+        (x1, y1), (x2, y2) = line
+        a = np.array([x1, y1], np.float32)
+        direction = np.array([x2 - x1, y2 - y1], np.float32)
+
+        def side(p):
+            rel = p - a
+            return np.sign(direction[0] * rel[:, 1] - direction[1] * rel[:, 0])
+
+        # 只统计跨越线段本身的轨迹（投影落在端点之间）
+        proj = ((points - a) @ direction) / float(direction @ direction)
+        crossed = (~np.isnan(prev[:, 0])) & (side(prev) != side(points)) & \
+                  (side(points) != 0) & (proj >= 0) & (proj <= 1)
+        pos = self.tracker.last_pos
+        crossed &= ~self.tracker.counted[pos]
+        self.tracker.counted[pos[crossed]] = True
+        return int(np.count_nonzero(crossed)), ids
+
+    # 检测 + 越线计数，不在帧上绘制；每个统计周期返回 (周期内通过数量, 累计数量)
+    def update(self, ctx):
+        self.polys = self.detect(ctx)
+        new, self.ids = self.track(self.polys, self._line(ctx.frame))
+        self.total_count += new
+        self.interval_count += new
 
-        # 每秒统计最大数量并返回
-        c = len(valid)
-        self.max_count = max(self.max_count, c)
         now = time.time()
-        if now - self.start_time >= 1.0:
-            res = self.max_count
+        if now - self.start_time >= self.interval:
+            res = (self.interval_count, self.total_count)
+            self.rate = self.interval_count / (now - self.start_time)
             self.start_time = now
-            self.max_count = 0
+            self.interval_count = 0
             return res
         return None
 
-# 更新全局实例
-package_counter = BoxCounter()
+    # 在帧上画多边形、轨迹 ID 和计数线
+    def draw(self, frame):
+        for poly, tid in zip(self.polys, self.ids):
+            cv2.polylines(frame, [poly], True, (255, 0, 0), 2)
+            x, y = poly.reshape(-1, 2).min(axis=0)
+            cv2.putText(frame, str(tid), (int(x), int(y) - 4),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 1)
+        line = self._line(frame)
+        cv2.line(frame, line[0], line[1], (0, 255, 255), 1)
+
+    # 前景掩码坐标 -> 全帧坐标的矩形
+    def mask_rect_to_frame(self, x, y, w, h):
+        ox, oy = (self.roi[0], self.roi[1]) if self.roi is not None else (0, 0)
+        return (int(x / self.scale) + ox, int(y / self.scale) + oy,
+                int(np.ceil(w / self.scale)), int(np.ceil(h / self.scale)))
+
+    def reset(self):
+        self.tracker.reset()
+        self.interval_count = 0
+        self.start_time = time.time()
+
+
+# ------------------------------------------------------------------------
+# 模板描述子索引：所有人的 ORB 描述子拼成一个矩阵 + 平行的标签数组，
+# 一次匹配调用覆盖所有人，再按标签投票。
+# 人数较少时用暴力汉明匹配；人数达到 lsh_min 后改用 FLANN LSH 近似索引
+# ------------------------------------------------------------------------
+FLANN_INDEX_LSH = 6
+
+class TemplateIndex:
+    def __init__(self, max_distance=60, lsh_min=20):
+        self.max_distance = max_distance
+        self.lsh_min = lsh_min
+        self.lock = threading.Lock()
+        self.label_ids = {}     # name -> label id
+        self.names = []         # label id -> name
+        self.descriptors = np.zeros((0, 32), np.uint8)
+        self.labels = np.zeros((0,), np.int32)
+        self.bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        self.bf_reverse = cv2.BFMatcher(cv2.NORM_HAMMING)
+        self.lsh = None
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def _label_id(self, name):
+        if name not in self.label_ids:
+            self.label_ids[name] = len(self.names)
+            self.names.append(name)
+        return self.label_ids[name]
+
+    def _drop(self, name):
+        lid = self.label_ids.get(name)
+        if lid is None:
+            return
+        keep = self.labels != lid
+        self.descriptors = self.descriptors[keep]
+        self.labels = self.labels[keep]
+
+    def _rebuild_lsh(self):
+        # LSH 哈希表需要整体重建；模板增删很少，放在增删线程里完成
+        if len(self.label_ids) < self.lsh_min or len(self.descriptors) == 0:
+            self.lsh = None
+            return
+        lsh = cv2.FlannBasedMatcher(
+            dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12,
+                 multi_probe_level=1),
+            dict(checks=32))
+        lsh.add([self.descriptors])
+        lsh.train()
+        self.lsh = lsh
+
+    # 新增或替换描述子（在已有矩阵上增量拼接），items 为 {姓名: 描述子}
+    def add_many(self, items):
+        with self.lock:
+            blocks, labels = [self.descriptors], [self.labels]
+            for name, des in items.items():
+                if des is None or len(des) == 0:
+                    continue
+                self._drop(name)
+                blocks[0], labels[0] = self.descriptors, self.labels
+                lid = self._label_id(name)
+                blocks.append(des)
+                labels.append(np.full(len(des), lid, np.int32))
+            self.descriptors = np.vstack(blocks)
+            self.labels = np.concatenate(labels)
+            self._rebuild_lsh()
+
+    def add(self, name, des):
+        self.add_many({name: des})
+
+    def remove(self, name):
+        with self.lock:
+            self._drop(name)
+            self.label_ids.pop(name, None)
+            self._rebuild_lsh()
+
+    def _match_indices(self, des, train, lsh):
+        if lsh is not None:
+            pairs = [p[0] for p in lsh.knnMatch(des, k=1)
+                     if p and p[0].distance < self.max_distance]
+            if not pairs:
+                return []
+            # 与暴力匹配的 crossCheck 相同的互为最近邻检查，两条路径共用 MATCH_THRESH：
+            # 命中的模板描述子（至多与查询一样多）反查它在查询描述子中的最近邻
+            hit, slot = np.unique([m.trainIdx for m in pairs], return_inverse=True)
+            nearest = {m.queryIdx: m.trainIdx for m in self.bf_reverse.match(train[hit], des)}
+            return [m.trainIdx for m, k in zip(pairs, slot) if nearest.get(int(k)) == m.queryIdx]
+        return [m.trainIdx for m in self.bf.match(des, train)
+                if m.distance < self.max_distance]
+
+    # 返回 (姓名, 票数)；库为空或无描述子时返回 ("Unknown", 0)
+    def match(self, des):
+        # 数组与 LSH 索引只整体替换不原地修改，拿到引用后即可无锁匹配
+        with self.lock:
+            train, labels, names, lsh = (self.descriptors, self.labels,
+                                         list(self.names), self.lsh)
+        if des is None or len(des) == 0 or len(train) == 0:
+            return "Unknown", 0
+        idx = np.array(self._match_indices(des, train, lsh), np.int32)
+        if len(idx) == 0:
+            return "Unknown", 0
+        votes = np.bincount(labels[idx], minlength=len(names))
+        best = int(np.argmax(votes))
+        return names[best], int(votes[best])
+
 
 
 
@@ -105,6 +418,21 @@ PORT = 8888
 TEMPLATE_PORT = 9999
 DELETE_PORT = 9998
 
+# 传输协议：2 为带通道/序号/时间戳的帧格式，1 为旧的 "VIDEO"+长度 格式
+WIRE_PROTOCOL = 2
+# 帧头：魔数 "LM"、版本、通道、标志、保留、序号 u32、采集时间 u64(微秒)、长度 u32
+WIRE_MAGIC = b"LM"
+WIRE_HEADER = struct.Struct(">2sBBBxIQI")
+CH_VIDEO, CH_AUDIO, CH_STATE = 1, 2, 3
+FLAG_KEEPALIVE = 0x01          # 视频通道：静止画面保活，无新图像
+FLAG_MORE = 0x02               # 分片：后面还有同一消息的分片（仅 v2）
+FLAG_SILENCE = 0x04            # 音频通道：静音标记，负载为 u32 静音采样数（每声道，仅 v2）
+FLAG_ACTIVITY = 0x08           # 视频通道：本帧检测到人脸或运动区域，客户端据此触发录像（仅 v2）
+VIDEO_FRAGMENT_SIZE = 16384    # 视频按此大小分片，分片之间可以插入音频/控制消息
+AUDIO_QUEUE_SIZE = 50          # 音频发送队列上限（块），满时丢弃最旧的块
+# 旧格式下各通道 / 标志对应的 5 字节头
+LEGACY_TAGS = {CH_VIDEO: b"VIDEO", CH_AUDIO: b"AUDIO", CH_STATE: b"STATE"}
+
 # 视频配置
 VIDEO_DEVICES = ["/dev/video0", "/dev/video2"]
 CURRENT_VIDEO_DEVICE = VIDEO_DEVICES[0]
@@ -112,18 +440,82 @@ TARGET_WIDTH = 640
 TARGET_HEIGHT = 480
 FPS = 10
 
+# 快递箱计数配置
+BOX_ROI = None     # 传送带区域 (x, y, w, h)，全帧坐标；None 表示全帧
+BOX_SCALE = 0.5    # 计数器处理分辨率比例，1.0 为原分辨率
+BOX_COUNT_LINE = None      # 计数线 ((x1, y1), (x2, y2))；None 为 ROI/全帧竖直中线
+BOX_REPORT_INTERVAL = 1.0  # 通过速率统计周期（秒）
+
+# 人脸检测运动门控
+MOTION_GATE = True              # 关闭时按固定间隔整帧检测
+MOTION_MIN_RATIO = 0.002        # 前景像素占比低于此值视为无运动
+MOTION_FULL_SCAN_PERIOD = 5.0   # 兜底整帧扫描周期（秒）
+MOTION_MAX_COVERAGE = 0.5       # 运动区域超过画面此比例时直接整帧扫描
+
+# 视频流水线配置
+PIPELINE_QUEUE_SIZE = 1        # 各级队列容量，满时丢弃最旧帧
+PIPELINE_REPORT_INTERVAL = 10  # 流水线状态打印间隔（秒）
+
+# 自适应码率：依次降低 JPEG 质量、分辨率、帧率以满足目标，链路恢复后逐级回升
+RATE_TARGET_KBPS = 4000        # 视频码率上限（kbit/s），None 表示不限
+RATE_TARGET_LATENCY = 0.3      # 采集到发送完成的延迟上限（秒），None 表示不限
+RATE_QUALITIES = [95, 85, 75, 65, 55, 45]
+RATE_SCALES = [1.0, 0.75, 0.5]
+RATE_FPS_LEVELS = [FPS, FPS * 2 // 3, FPS // 2, max(1, FPS // 4)]
+RATE_RECOVER_SECONDS = 3       # 连续达标多少秒后尝试回升一级
+
+# 静止画面抑制：与上次发送的帧相比没有明显变化时只发保活包
+STATIC_SUPPRESS = True
+STATIC_PIXEL_DIFF = 12         # 缩略图单像素灰度差超过此值算变化
+STATIC_MIN_CHANGED = 0.003     # 变化像素占比低于此值视为静止
+STATIC_REFRESH_SECONDS = 5.0   # 静止时强制刷新整帧的周期（秒）
+
 # 音频配置
 AUDIO_FORMAT = pyaudio.paInt16
 CHANNELS = 2
 RATE = 44100
 CHUNK = 1024
 
+# 音频编码：客户端在会话开始时发送 "AUDIO codecs=ulaw,pcm16 rate=16000 channels=1"
+# 协商，设备端按下表顺序选第一个双方都支持的编码，并通过控制消息告知实际格式。
+# 未协商时（旧客户端）保持原始 44.1kHz 立体声 PCM
+AUDIO_CODEC_PREFERENCE = ["ulaw", "pcm16"]
+
+# 静音抑制：RMS 和峰值都低于阈值的块视为静音，只发送 "静音 N 个采样" 标记，
+# 客户端按采样数补零播放。声音结束后再多发 HANGOVER 秒真实音频，避免切掉尾音
+AUDIO_SILENCE_SUPPRESS = True
+AUDIO_SILENCE_RMS = 200            # int16 幅度
+AUDIO_SILENCE_PEAK = 1000
+AUDIO_SILENCE_HANGOVER = 0.3       # 秒
+AUDIO_SILENCE_MARKER_SECONDS = 0.05  # 连续静音合并成一个标记的最长时长，需小于客户端抖动缓冲
+AUDIO_CLOCK_RESYNC = 0.1       # 采样计数推算的时间与系统时间相差超过此值（溢出丢采样、时钟漂移）时重新对时
+
 # 人脸识别配置
 TEMPLATE_DIR = "templates"
 MATCH_THRESH = 10
+FACE_EQUALIZE_HIST = False   # 级联检测前做直方图均衡（逆光/暗场景下可打开）
+MATCH_DISTANCE = 60   # ORB 汉明距离小于此值视为有效匹配
+TEMPLATE_LSH_MIN = 20  # 模板人数达到此值后改用 LSH 索引
+
+# 识别结果缓存：框位置基本不变时复用上次识别结果
+RECOG_CACHE_TTL = 2.0          # 已识别人脸结果的有效期（秒）
+RECOG_CACHE_UNKNOWN_TTL = 0.5  # Unknown / 低置信度结果的有效期（秒）
+RECOG_CACHE_IOU = 0.3          # 新旧框 IoU 不低于此值视为同一张脸
+RECOG_CACHE_SHIFT = 0.5        # 或中心点位移不超过框边长的此比例
+
+# 多进程人脸识别：0 表示在分析线程内同步识别
+RECOG_WORKERS = 0
+RECOG_SLOTS = 8                # 共享内存中的 ROI 槽位数
+RECOG_SLOT_SIZE = 256 * 256    # 每个槽位字节数，更大的 ROI 先等比缩小
+RECOG_POOL_TIMEOUT = 1.0       # 提交后超过此时间仍无结果则重新提交（秒）
 
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
 
+# 更新全局实例
+package_counter = BoxCounter(roi=BOX_ROI, scale=BOX_SCALE,
+                             count_line=BOX_COUNT_LINE,
+                             interval=BOX_REPORT_INTERVAL)
+
 # 全局标志和锁
 running_flag = threading.Event()
 running_flag.set()
@@ -135,6 +527,9 @@ face_cascade = None
 orb = cv2.ORB_create()
 bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
 templates = {}
+template_index = TemplateIndex(MATCH_DISTANCE, TEMPLATE_LSH_MIN)
+template_version = 0   # 模板每次增删加一，识别缓存据此失效
+recog_pool = None      # RecognitionPool，RECOG_WORKERS > 0 时在启动时创建
 
 # -----------------------------------------------------------------------------
 def load_face_cascade():
@@ -154,6 +549,7 @@ def load_face_cascade():
 
 def load_existing_templates():
     global templates
+    loaded = {}
     for file in os.listdir(TEMPLATE_DIR):
         if file.lower().endswith(".jpg"):
             name = os.path.splitext(file)[0]
@@ -163,29 +559,340 @@ def load_existing_templates():
             kp, des = orb.detectAndCompute(img, None)
             if des is not None:
                 templates[name] = (kp, des)
+                loaded[name] = des
                 print(f"[INFO] 载入模板 {name}，特征点 {len(kp)}")
+    template_index.add_many(loaded)
 
-def recognize(face_img):
+# 返回 (姓名, 匹配得分)，得分为最佳模板的有效匹配点数；face_img 可为 BGR 或灰度
+def recognize_face(face_img):
     if face_img is None or face_img.size == 0:
-        return "Unknown"
-    gray = cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY)
+        return "Unknown", 0
+    gray = face_img if face_img.ndim == 2 else cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY)
     kp, des = orb.detectAndCompute(gray, None)
     if des is None:
-        return "Unknown"
-    best_name, best_score = "Unknown", 0
-    for name, (t_kp, t_des) in templates.items():
-        if t_des is None or len(t_des) == 0:
-            continue
+        return "Unknown", 0
+    try:
+        best_name, best_score = template_index.match(des)
+    except cv2.error as e:
+        print(f"[ERROR] ORB 匹配错误: {e}")
+        return "Unknown", 0
+    if best_score < MATCH_THRESH:
+        return "Unknown", best_score
+    return best_name, best_score
+
+# ------------------------------------------------------------------------
+# 人脸识别缓存：按 IoU / 中心点把新框关联到上一帧的框，复用识别结果，
+# 直到框移动过远、结果过期或置信度不足时才重新调用 recognize_face()
+# ------------------------------------------------------------------------
+class FaceRecognitionCache:
+    def __init__(self,
+                 ttl=RECOG_CACHE_TTL,
+                 unknown_ttl=RECOG_CACHE_UNKNOWN_TTL,
+                 iou_thresh=RECOG_CACHE_IOU,
+                 max_shift=RECOG_CACHE_SHIFT,
+                 min_score=MATCH_THRESH):
+        self.ttl = ttl
+        self.unknown_ttl = unknown_ttl
+        self.iou_thresh = iou_thresh
+        self.max_shift = max_shift
+        self.min_score = min_score
+        self.entries = []   # [{"id", "box", "label", "score", "ts", "pending"}]
+        self.version = template_version
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.busy = 0       # 进程池槽位用尽、本帧沿用旧结果的次数
+
+    @staticmethod
+    def _iou(a, b):
+        ax, ay, aw, ah = a
+        bx, by, bw, bh = b
+        iw = min(ax + aw, bx + bw) - max(ax, bx)
+        ih = min(ay + ah, by + bh) - max(ay, by)
+        if iw <= 0 or ih <= 0:
+            return 0.0
+        inter = iw * ih
+        return inter / float(aw * ah + bw * bh - inter)
+
+    def _same_face(self, old, new):
+        if self._iou(old, new) >= self.iou_thresh:
+            return True
+        ox, oy, ow, oh = old
+        nx, ny, nw, nh = new
+        dx = (ox + ow / 2.0) - (nx + nw / 2.0)
+        dy = (oy + oh / 2.0) - (ny + nh / 2.0)
+        limit = self.max_shift * max(ow, oh, nw, nh)
+        return dx * dx + dy * dy <= limit * limit
+
+    def _fresh(self, entry, now):
+        if entry.get("pending"):
+            return now - entry["ts"] <= RECOG_POOL_TIMEOUT
+        ttl = self.ttl if entry["score"] >= self.min_score else self.unknown_ttl
+        return now - entry["ts"] <= ttl
+
+    def _new_entry(self, box, label, score, now, pending=False):
+        self.next_id += 1
+        return {"id": self.next_id, "box": box, "label": label, "score": score,
+                "ts": now, "pending": pending}
+
+    # 进程池模式：ROI 交给工作进程，结果返回前沿用旧标签
+    def _submit(self, roi, box, old, now):
+        label, score = (old["label"], old["score"]) if old else ("Unknown", 0)
+        entry = self._new_entry(box, label, score, now, pending=True)
+        if recog_pool.submit(entry["id"], roi):
+            self.misses += 1
+            return entry
+        self.busy += 1
+        if old is not None:
+            return dict(old, box=box)
+        entry["pending"] = False
+        return entry
+
+    def _merge(self, results, now):
+        by_id = {e["id"]: e for e in self.entries}
+        for key, label, score in results:
+            entry = by_id.get(key)
+            if entry is not None:
+                entry.update(label=label, score=score, ts=now, pending=False)
+
+    # 对本帧所有人脸框返回 [(x, y, w, h, label)]，并用本帧结果替换缓存；
+    # frame 传灰度图时识别无需再逐个 ROI 转灰度
+    def update(self, frame, faces, now=None):
+        if now is None:
+            now = time.time()
+        if self.version != template_version:
+            # 模板增删后旧标签可能失效
+            self.entries = []
+            self.version = template_version
+        if recog_pool is not None:
+            self._merge(recog_pool.poll(), now)
+        unused = list(self.entries)
+        results, entries = [], []
+        for (x, y, w, h) in faces:
+            box = (int(x), int(y), int(w), int(h))
+            entry = None
+            for old in unused:
+                if self._same_face(old["box"], box):
+                    entry = old
+                    break
+            if entry is not None:
+                unused.remove(entry)
+            if entry is not None and self._fresh(entry, now):
+                self.hits += 1
+                entry = dict(entry, box=box)
+            elif recog_pool is not None:
+                entry = self._submit(frame[y:y+h, x:x+w], box, entry, now)
+            else:
+                self.misses += 1
+                label, score = recognize_face(frame[y:y+h, x:x+w])
+                entry = self._new_entry(box, label, score, now)
+            entries.append(entry)
+            results.append(box + (entry["label"],))
+        # 本帧未关联上的旧条目视为人脸已离开
+        self.entries = entries
+        return results
+
+    def clear(self):
+        self.entries = []
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return {"hits": self.hits, "misses": self.misses, "busy": self.busy,
+                "hit_rate": rate}
+
+# ------------------------------------------------------------------------
+# 多进程识别池：每个工作进程持有一份 TemplateIndex 副本。
+# 人脸 ROI（灰度）写入 fork 前创建的共享内存槽位，队列里只传槽位号和尺寸，
+# 不对图像做 pickle；结果异步取回后由 FaceRecognitionCache 合并。
+# 模板增删通过每个进程各自的控制队列广播，处理下一个任务前生效
+# ------------------------------------------------------------------------
+def _recognition_worker(buf, slot_size, tasks, control, results, initial):
+    index = TemplateIndex(MATCH_DISTANCE, TEMPLATE_LSH_MIN)
+    index.add_many(initial)
+    worker_orb = cv2.ORB_create()
+    shm = np.frombuffer(buf, np.uint8)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        # 先应用等待中的模板增删，再处理任务
+        try:
+            while True:
+                op, name, des = control.get_nowait()
+                if op == "add":
+                    index.add(name, des)
+                else:
+                    index.remove(name)
+        except queue.Empty:
+            pass
+        key, slot, h, w = task
+        start = slot * slot_size
+        roi = shm[start:start + h * w].reshape(h, w)
+        label, score = "Unknown", 0
         try:
-            matches = bf.match(t_des, des)
-            good = [m for m in matches if m.distance < 60]
-            if len(good) > best_score:
-                best_score = len(good)
-                best_name = name
+            kp, des = worker_orb.detectAndCompute(roi, None)
+            label, score = index.match(des)
         except cv2.error as e:
-            print(f"[ERROR] ORB 匹配错误: {e}")
-            continue
-    return best_name if best_score >= MATCH_THRESH else "Unknown"
+            print(f"[ERROR] 识别进程 ORB 错误: {e}")
+        if score < MATCH_THRESH:
+            label = "Unknown"
+        results.put((key, slot, label, score))
+
+class RecognitionPool:
+    def __init__(self, workers, slots=RECOG_SLOTS, slot_size=RECOG_SLOT_SIZE):
+        ctx = multiprocessing.get_context("fork")
+        self.slot_size = slot_size
+        self.buf = ctx.RawArray('B', slots * slot_size)
+        self.shm = np.frombuffer(self.buf, np.uint8)
+        self.free = deque(range(slots))
+        self.lock = threading.Lock()
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.controls = [ctx.Queue() for _ in range(workers)]
+        initial = {name: des for name, (kp, des) in templates.items()}
+        self.procs = [
+            ctx.Process(target=_recognition_worker,
+                        args=(self.buf, slot_size, self.tasks, q, self.results, initial),
+                        daemon=True)
+            for q in self.controls
+        ]
+        for p in self.procs:
+            p.start()
+        print(f"[设备端] 识别进程池启动: {workers} 个进程, {slots} 个槽位")
+
+    # 槽位用尽时返回 False
+    def submit(self, key, gray_roi):
+        with self.lock:
+            if not self.free:
+                return False
+            slot = self.free.popleft()
+        h, w = gray_roi.shape[:2]
+        if h * w > self.slot_size:
+            k = (self.slot_size / float(h * w)) ** 0.5
+            gray_roi = cv2.resize(gray_roi, (max(1, int(w * k)), max(1, int(h * k))),
+                                  interpolation=cv2.INTER_AREA)
+            h, w = gray_roi.shape[:2]
+        start = slot * self.slot_size
+        self.shm[start:start + h * w].reshape(h, w)[:] = gray_roi
+        self.tasks.put((key, slot, h, w))
+        return True
+
+    # 取回已完成的结果 [(key, label, score)]，不阻塞
+    def poll(self):
+        done = []
+        while True:
+            try:
+                key, slot, label, score = self.results.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.free.append(slot)
+            done.append((key, label, score))
+        return done
+
+    def add_template(self, name, des):
+        for q in self.controls:
+            q.put(("add", name, des))
+
+    def remove_template(self, name):
+        for q in self.controls:
+            q.put(("remove", name, None))
+
+    def close(self):
+        for _ in self.procs:
+            self.tasks.put(None)
+        for p in self.procs:
+            p.join(timeout=1)
+
+# ------------------------------------------------------------------------
+# 运动门控：只在前景掩码有足够变化时运行人脸级联分类器，并且只扫描运动区域；
+# 另按较低频率做整帧扫描兜底（静止站立的人会被背景模型吸收）。
+# 计数器覆盖全帧时直接复用它的 MOG2 掩码，否则自建一个低分辨率背景模型
+# ------------------------------------------------------------------------
+class MotionGate:
+    def __init__(self,
+                 counter,
+                 min_ratio=MOTION_MIN_RATIO,
+                 full_scan_period=MOTION_FULL_SCAN_PERIOD,
+                 max_coverage=MOTION_MAX_COVERAGE,
+                 scale=0.25,
+                 pad=0.3):
+        self.counter = counter
+        self.min_ratio = min_ratio
+        self.full_scan_period = full_scan_period
+        self.max_coverage = max_coverage
+        self.pad = pad
+        self.own_scale = scale
+        self.bgsub = None
+        if counter.roi is not None:
+            self.bgsub = cv2.createBackgroundSubtractorMOG2(
+                history=500, varThreshold=30, detectShadows=False)
+            self.kern = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        self.last_full = 0.0
+        self.counts = {"full": 0, "motion": 0, "idle": 0}
+
+    def foreground_mask(self, ctx):
+        fg = self.bgsub.apply(ctx.small_gray(self.own_scale))
+        _, th = cv2.threshold(fg, 180, 255, cv2.THRESH_BINARY)
+        return cv2.morphologyEx(th, cv2.MORPH_OPEN, self.kern)
+
+    def _own_rect_to_frame(self, x, y, w, h):
+        k = self.own_scale
+        return int(x / k), int(y / k), int(np.ceil(w / k)), int(np.ceil(h / k))
+
+    def _mask(self, ctx):
+        if self.bgsub is None:
+            return ctx.foreground(self.counter), self.counter.mask_rect_to_frame
+        return ctx.foreground(self), self._own_rect_to_frame
+
+    # 返回 ("full", None) / ("motion", [(x, y, w, h), ...]) / ("idle", None)
+    def decide(self, ctx, now=None):
+        if now is None:
+            now = time.time()
+        mask, to_frame = self._mask(ctx)
+        if mask is None or now - self.last_full >= self.full_scan_period:
+            return self._full(now)
+
+        if cv2.countNonZero(mask) < self.min_ratio * mask.size:
+            self.counts["idle"] += 1
+            return "idle", None
+
+        cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours = cnts[1] if len(cnts) == 3 else cnts[0]
+        fh, fw = ctx.frame.shape[:2]
+        regions, covered = [], 0
+        for cnt in contours:
+            x, y, w, h = to_frame(*cv2.boundingRect(cnt))
+            # 扩边，给级联留出人脸周围的上下文
+            px, py = int(w * self.pad) + 20, int(h * self.pad) + 20
+            x0, y0 = max(0, x - px), max(0, y - py)
+            x1, y1 = min(fw, x + w + px), min(fh, y + h + py)
+            if x1 - x0 < 40 or y1 - y0 < 40:
+                continue
+            regions.append((x0, y0, x1 - x0, y1 - y0))
+            covered += (x1 - x0) * (y1 - y0)
+        if not regions:
+            self.counts["idle"] += 1
+            return "idle", None
+        if covered > self.max_coverage * fw * fh:
+            return self._full(now)
+        self.counts["motion"] += 1
+        return "motion", regions
+
+    def _full(self, now):
+        self.last_full = now
+        self.counts["full"] += 1
+        return "full", None
+
+def detect_faces(gray, regions=None):
+    if regions is None:
+        return [tuple(f) for f in face_cascade.detectMultiScale(gray, 1.1, 3, minSize=(40, 40))]
+    faces = []
+    for (x, y, w, h) in regions:
+        found = face_cascade.detectMultiScale(gray[y:y+h, x:x+w], 1.1, 3, minSize=(40, 40))
+        faces.extend((fx + x, fy + y, fw, fh) for (fx, fy, fw, fh) in found)
+    return faces
 
 def switch_video_device(new_device):
     global CURRENT_VIDEO_DEVICE, cap
@@ -202,12 +909,469 @@ def switch_video_device(new_device):
         print(f"[设备端] 切换摄像头到: {CURRENT_VIDEO_DEVICE}")
         return True
 
-def video_stream(conn):
-    global cap
+# ------------------------------------------------------------------------
+# 消息发送器：所有线程共用一个套接字，每条消息持锁用一次 sendmsg
+# （帧头 + 负载分散/聚集写）原子写出，避免视频/音频线程交错写坏数据流
+# ------------------------------------------------------------------------
+class WireWriter:
+    def __init__(self, conn, version=WIRE_PROTOCOL):
+        self.conn = conn
+        self.version = version
+        self.lock = threading.Lock()
+        self.seq = {}
+
+    def _header(self, channel, payload, flags, ts):
+        if self.version < 2:
+            tag = b"KEEPA" if flags & FLAG_KEEPALIVE else LEGACY_TAGS[channel]
+            return tag + len(payload).to_bytes(4, 'big')
+        seq = self.seq.get(channel, 0)
+        self.seq[channel] = (seq + 1) & 0xFFFFFFFF
+        return WIRE_HEADER.pack(WIRE_MAGIC, self.version, channel, flags, seq,
+                                int(ts * 1000000), len(payload))
+
+    # ts 为采集时间（time.time() 秒），返回写出的字节数
+    def send(self, channel, payload, flags=0, ts=None):
+        if ts is None:
+            ts = time.time()
+        with self.lock:
+            header = self._header(channel, payload, flags, ts)
+            total = len(header) + len(payload)
+            sent = self.conn.sendmsg([header, payload])
+            if sent < total:
+                # 阻塞套接字上极少出现的部分写，补齐剩余部分
+                rest = memoryview(header + bytes(payload))[sent:]
+                self.conn.sendall(rest)
+        return total
+
+# ------------------------------------------------------------------------
+# 发送调度器：唯一持有套接字的线程，按优先级从各通道取消息：
+# 控制 > 音频 > 视频。视频是 latest-wins 单槽，未开始发送的旧帧被新帧替换；
+# v2 协议下视频按 VIDEO_FRAGMENT_SIZE 分片，每发一片就重新检查控制/音频队列，
+# 因此音频最多等待一个分片的发送时间，而不是一整帧 JPEG
+# ------------------------------------------------------------------------
+class SendScheduler:
+    def __init__(self, wire, audio_max=AUDIO_QUEUE_SIZE, on_video_sent=None):
+        self.wire = wire
+        self.cond = threading.Condition()
+        self.control = deque()
+        self.audio = deque()
+        self.audio_max = audio_max
+        self.video = None          # 等待发送的最新一帧 (payload, flags, ts, enqueued)
+        self.on_video_sent = on_video_sent
+        self.stats = {ch: {"sent": 0, "drops": 0, "latency": 0.0, "max_latency": 0.0}
+                      for ch in ("control", "audio", "video")}
+
+    def send_control(self, payload):
+        with self.cond:
+            self.control.append((CH_STATE, payload, 0, time.time(), time.time()))
+            self.cond.notify()
+
+    # 音频格式变化：丢弃还在排队的旧格式音频，再排入格式通知。控制消息优先于音频，
+    # 若不清空，旧格式的音频会在通知之后到达，被客户端按新格式解码
+    def send_audio_format(self, payload):
+        with self.cond:
+            self.stats["audio"]["drops"] += len(self.audio)
+            self.audio.clear()
+            self.control.append((CH_STATE, payload, 0, time.time(), time.time()))
+            self.cond.notify()
+
+    def send_audio(self, payload, ts, flags=0):
+        with self.cond:
+            if len(self.audio) >= self.audio_max:
+                self.audio.popleft()
+                self.stats["audio"]["drops"] += 1
+            self.audio.append((CH_AUDIO, payload, flags, ts, time.time()))
+            self.cond.notify()
+
+    def send_video(self, payload, ts, flags=0):
+        with self.cond:
+            if self.video is not None:
+                self.stats["video"]["drops"] += 1
+            self.video = (payload, flags, ts, time.time())
+            self.cond.notify()
+
+    def _record(self, name, enqueued):
+        st = self.stats[name]
+        latency = time.time() - enqueued
+        st["sent"] += 1
+        st["latency"] = latency if st["sent"] == 1 else 0.9 * st["latency"] + 0.1 * latency
+        st["max_latency"] = max(st["max_latency"], latency)
+
+    # 取下一条控制或音频消息；都为空时返回 None
+    def _next_urgent(self):
+        if self.control:
+            return "control", self.control.popleft()
+        if self.audio:
+            return "audio", self.audio.popleft()
+        return None
+
+    def _drain_urgent(self):
+        while True:
+            with self.cond:
+                nxt = self._next_urgent()
+            if nxt is None:
+                return
+            name, (channel, payload, flags, ts, enqueued) = nxt
+            self.wire.send(channel, payload, flags, ts)
+            self._record(name, enqueued)
+
+    def _send_video(self, payload, flags, ts, enqueued):
+        fragment = VIDEO_FRAGMENT_SIZE if self.wire.version >= 2 else len(payload)
+        view = memoryview(payload)
+        nbytes, busy = 0, 0.0
+        for start in range(0, len(payload), fragment):
+            end = start + fragment
+            more = FLAG_MORE if end < len(payload) else 0
+            t0 = time.time()
+            nbytes += self.wire.send(CH_VIDEO, view[start:end], flags | more, ts)
+            busy += time.time() - t0
+            if more:
+                self._drain_urgent()
+        self._record("video", enqueued)
+        if self.on_video_sent is not None:
+            self.on_video_sent(nbytes, busy, ts, flags)
+
+    def run(self):
+        try:
+            while running_flag.is_set():
+                with self.cond:
+                    if not (self.control or self.audio or self.video):
+                        self.cond.wait(0.5)
+                    nxt = self._next_urgent()
+                    video = None
+                    if nxt is None and self.video is not None:
+                        video, self.video = self.video, None
+                if nxt is not None:
+                    name, (channel, payload, flags, ts, enqueued) = nxt
+                    self.wire.send(channel, payload, flags, ts)
+                    self._record(name, enqueued)
+                elif video is not None:
+                    self._send_video(*video)
+        except BrokenPipeError:
+            print("[设备端] 数据流断开")
+        except Exception as e:
+            print(f"[设备端] 发送异常: {e}")
+        running_flag.clear()
+        print("[设备端] 发送线程停止")
+
+    def report(self):
+        parts = []
+        for name, st in self.stats.items():
+            parts.append(f"{name} 发送 {st['sent']} 丢弃 {st['drops']} "
+                         f"延迟 {st['latency'] * 1000:.0f}/{st['max_latency'] * 1000:.0f} ms")
+            st["max_latency"] = 0.0
+        return ", ".join(parts)
+
+# ------------------------------------------------------------------------
+# 视频流水线：采集 → 分析 → 编码 → 发送，各级独立线程，级间为有界队列。
+# 队列满时丢弃最旧的帧（latest-wins），某一级卡顿时不会积压延迟；
+# OpenCV 调用期间释放 GIL，采集解码、分析和编码可以在两个核上并行
+# ------------------------------------------------------------------------
+class LatestQueue:
+    def __init__(self, name, maxsize=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.puts = 0
+        self.drops = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.cond:
+            while len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.drops += 1
+            self.items.append(item)
+            self.puts += 1
+            self.cond.notify()
+
+    # 超时返回 None，便于调用方检查 running_flag
+    def get(self, timeout=0.5):
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+def _draw_faces(frame, results):
+    for (x, y, w, h, label) in results:
+        color = (0, 255, 0) if label != "Unknown" else (0, 0, 255)
+        cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
+        cv2.putText(frame, label, (x, y-10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+
+def analyze_stage(in_q, out_q):
     frame_cnt, interval = 0, 5
     cached_faces = []
+    recog_cache = FaceRecognitionCache()
+    gate = MotionGate(package_counter) if MOTION_GATE else None
+    session = None
+    motion = False
+    detected = False    # 最近一次检测（非 idle）是否找到人脸
+
+    while running_flag.is_set():
+        item = in_q.get()
+        if item is None:
+            continue
+        frame = item["frame"]
+        if item["session"] != session:
+            # 摄像头重新打开或切换后旧的人脸框不再可信
+            session = item["session"]
+            cached_faces = []
+            motion = detected = False
+            recog_cache.clear()
+            package_counter.reset()
+
+        ctx = FrameContext(frame)
+
+        # ------ 快递箱越线计数（先于人脸检测，前景掩码供运动门控使用）------
+        result = package_counter.update(ctx)
+        if result is not None:
+            passed, total = result
+            print(f"[设备端] 本周期通过快递箱 {passed} 个，累计 {total} 个")
+
+        if frame_cnt % interval == 0:
+            decision, regions = gate.decide(ctx) if gate else ("full", None)
+            motion = decision == "motion"
+            if decision != "idle":
+                g = ctx.equalized if FACE_EQUALIZE_HIST else ctx.gray
+                cached_faces = detect_faces(g, regions)
+            # idle 时人脸框仍沿用到下次整帧扫描，但不再算作活动，否则场景空了之后
+            # 活动标记还要持续一个 MOTION_FULL_SCAN_PERIOD
+            detected = decision != "idle" and bool(cached_faces)
+        faces = cached_faces
+        # 保活包也带上此标记，画面被静止过滤时客户端仍知道检测结果
+        item["active"] = motion or detected
+
+        _draw_faces(frame, recog_cache.update(ctx.gray, faces))
+        ctx.release()
+        package_counter.draw(frame)
+        cv2.putText(frame,
+                    f"{package_counter.rate:.1f} pkg/s  total {package_counter.total_count}",
+                    (10, TARGET_HEIGHT - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.7,
+                    (0, 0, 255), 2)
+        # ────────────────────────────────────────
+
+        out_q.put(item)
+        frame_cnt += 1
+        if frame_cnt % 100 == 0:
+            st = recog_cache.stats()
+            print(f"[设备端] 识别缓存 命中 {st['hits']} / 未命中 {st['misses']} "
+                  f"/ 进程池忙 {st['busy']} (命中率 {st['hit_rate']:.0%})")
+            if gate:
+                c = gate.counts
+                print(f"[设备端] 运动门控 整帧 {c['full']} / 区域 {c['motion']} / 跳过 {c['idle']}")
+    print("[设备端] 分析线程停止")
+
+# ------------------------------------------------------------------------
+# 码率控制器：统计发送字节数、sendall 阻塞时间和采集→发送延迟，
+# 每秒评估一次。超出码率或延迟目标时沿档位表下降一档（先质量、再分辨率、
+# 最后帧率），连续达标后回升一档；回升后马上又超标则加倍等待时间
+# ------------------------------------------------------------------------
+class RateController:
+    def __init__(self,
+                 target_kbps=RATE_TARGET_KBPS,
+                 target_latency=RATE_TARGET_LATENCY,
+                 qualities=RATE_QUALITIES,
+                 scales=RATE_SCALES,
+                 fps_levels=RATE_FPS_LEVELS):
+        self.target_kbps = target_kbps
+        self.target_latency = target_latency
+        q_min, s_min, f_max = qualities[-1], scales[-1], fps_levels[0]
+        self.ladder = ([(q, scales[0], f_max) for q in qualities] +
+                       [(q_min, sc, f_max) for sc in scales[1:]] +
+                       [(q_min, s_min, f) for f in fps_levels[1:]])
+        self.level = 0
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.bytes = 0
+        self.send_time = 0.0
+        self.latency = 0.0
+        self.last_latency = 0.0
+        self.good_since = None
+        self.recover_hold = RATE_RECOVER_SECONDS
+        self.last_up = 0.0
+        self.kbps = 0.0
+        self.link_kbps = 0.0
+
+    @property
+    def point(self):
+        q, sc, f = self.ladder[self.level]
+        return {"quality": q, "scale": sc, "fps": f}
+
+    def on_sent(self, nbytes, send_seconds, latency):
+        with self.lock:
+            self.bytes += nbytes
+            self.send_time += send_seconds
+            self.latency = max(self.latency, latency)
+
+    def _over(self):
+        if self.target_kbps and self.kbps > self.target_kbps:
+            return True
+        return bool(self.target_latency) and self.latency > self.target_latency
+
+    def _headroom(self):
+        # 回升后码率大约增加 30%，预计仍在目标和链路能力以内才回升
+        if self.target_kbps and self.kbps * 1.3 > self.target_kbps * 0.9:
+            return False
+        if self.link_kbps and self.kbps * 1.3 > self.link_kbps * 0.8:
+            return False
+        return not self.target_latency or self.latency < self.target_latency * 0.5
+
+    # 返回 True 表示档位发生变化
+    def evaluate(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            elapsed = now - self.window_start
+            if elapsed < 1.0:
+                return False
+            self.kbps = self.bytes * 8 / 1000.0 / elapsed
+            if self.send_time > 0:
+                link = self.bytes * 8 / 1000.0 / self.send_time
+                self.link_kbps = link if not self.link_kbps else 0.7 * self.link_kbps + 0.3 * link
+            over, headroom = self._over(), self._headroom()
+            self.window_start, self.bytes, self.send_time = now, 0, 0.0
+            latency, self.latency = self.latency, 0.0
+
+            old = self.level
+            if over:
+                self.good_since = None
+                step = 2 if self.target_latency and latency > 2 * self.target_latency else 1
+                self.level = min(len(self.ladder) - 1, self.level + step)
+                if now - self.last_up < self.recover_hold:
+                    self.recover_hold = min(60, self.recover_hold * 2)
+            elif headroom and self.level > 0:
+                if self.good_since is None:
+                    self.good_since = now
+                elif now - self.good_since >= self.recover_hold:
+                    self.level -= 1
+                    self.last_up = now
+                    self.good_since = None
+            else:
+                self.good_since = None
+            if now - self.last_up > 60:
+                self.recover_hold = RATE_RECOVER_SECONDS
+            self.last_latency = latency
+            return self.level != old
+
+    def report(self):
+        rep = dict(self.point)
+        rep.update(level=self.level, kbps=round(self.kbps, 1),
+                   link_kbps=round(self.link_kbps, 1),
+                   latency_ms=int(self.last_latency * 1000))
+        return rep
+
+# ------------------------------------------------------------------------
+# 静止画面过滤器：把（已叠加标注的）帧缩成 80x60 灰度缩略图，
+# 与上次真正发送的帧逐像素比较；变化像素太少则跳过编码，只发保活包，
+# 并按 refresh 周期强制发送一帧
+# ------------------------------------------------------------------------
+class StaticSceneFilter:
+    def __init__(self,
+                 pixel_diff=STATIC_PIXEL_DIFF,
+                 min_changed=STATIC_MIN_CHANGED,
+                 refresh=STATIC_REFRESH_SECONDS,
+                 size=(80, 60)):
+        self.pixel_diff = pixel_diff
+        self.min_changed = min_changed
+        self.refresh = refresh
+        self.size = size
+        self.last_thumb = None
+        self.last_sent = 0.0
+        self.sent = 0
+        self.suppressed = 0
+
+    def should_send(self, frame, now=None):
+        if now is None:
+            now = time.time()
+        thumb = cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA),
+                             cv2.COLOR_BGR2GRAY)
+        if self.last_thumb is not None and now - self.last_sent < self.refresh:
+            diff = cv2.absdiff(thumb, self.last_thumb)
+            changed = np.count_nonzero(diff > self.pixel_diff)
+            if changed < self.min_changed * diff.size:
+                self.suppressed += 1
+                return False
+        self.last_thumb = thumb
+        self.last_sent = now
+        self.sent += 1
+        return True
+
+def encode_stage(in_q, scheduler, controller, stats):
+    static = StaticSceneFilter() if STATIC_SUPPRESS else None
+    while running_flag.is_set():
+        item = in_q.get()
+        if item is None:
+            continue
+        point = controller.point
+        frame = item.pop("frame")
+        activity = FLAG_ACTIVITY if item.get("active") else 0
+        if static is not None and not static.should_send(frame, item["ts"]):
+            # 静止画面：只发帧号作为保活，客户端沿用上一帧
+            stats["suppressed"] += 1
+            scheduler.send_video((item["id"] & 0xFFFFFFFF).to_bytes(4, 'big'),
+                                 item["ts"], FLAG_KEEPALIVE | activity)
+            continue
+        if point["scale"] != 1.0:
+            frame = cv2.resize(frame, None, fx=point["scale"], fy=point["scale"],
+                               interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode(".jpg", frame,
+                                   [int(cv2.IMWRITE_JPEG_QUALITY), point["quality"]])
+        if not ok:
+            print("[设备端] 警告: 视频编码失败")
+            continue
+        scheduler.send_video(encoded.tobytes(), item["ts"], activity)
+    print("[设备端] 编码线程停止")
+
+def report_pipeline(queues, stats, elapsed, scheduler):
+    depths = " ".join(f"{q.name}={len(q)}/{q.maxsize}" for q in queues)
+    drops = " ".join(f"{q.name}={q.drops}" for q in queues)
+    fps = stats["sent"] / elapsed if elapsed > 0 else 0.0
+    print(f"[设备端] 流水线 发送 {fps:.1f} fps (其中静止保活 {stats['suppressed']}), "
+          f"延迟 {stats['latency'] * 1000:.0f} ms, 队列 {depths}, 丢帧 {drops}")
+    print(f"[设备端] 发送调度 {scheduler.report()}")
+    stats["sent"] = 0
+    stats["suppressed"] = 0
+
+def video_stream(scheduler):
+    global cap
     max_retries, retry_count = 3, 0
+    session = 0
+
+    analyze_q = LatestQueue("analyze")
+    encode_q = LatestQueue("encode")
+    stats = {"sent": 0, "suppressed": 0, "latency": 0.0}
+    controller = RateController()
+    last_state = [0.0]
+
+    # 在发送线程中回调：更新码率控制器，档位变化时立即、否则每 5 秒通知客户端
+    def on_video_sent(nbytes, busy, ts, flags):
+        now = time.time()
+        controller.on_sent(nbytes, busy, now - ts)
+        stats["sent"] += 1
+        stats["latency"] = now - ts
+        if controller.evaluate(now) or now - last_state[0] >= 5:
+            scheduler.send_control(json.dumps({"rate": controller.report()}).encode("utf-8"))
+            last_state[0] = now
+
+    scheduler.on_video_sent = on_video_sent
+    stages = [
+        threading.Thread(target=analyze_stage, args=(analyze_q, encode_q), daemon=True),
+        threading.Thread(target=encode_stage, args=(encode_q, scheduler, controller, stats),
+                         daemon=True),
+    ]
+    for t in stages:
+        t.start()
 
+    last_report = time.time()
+    frame_id = 0
     while running_flag.is_set() and retry_count < max_retries:
         with device_lock:
             cap = cv2.VideoCapture(CURRENT_VIDEO_DEVICE)
@@ -220,58 +1384,35 @@ def video_stream(conn):
             cap.set(cv2.CAP_PROP_FRAME_HEIGHT, TARGET_HEIGHT)
             cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
             retry_count = 0
+            session += 1
             print(f"[设备端] 摄像头初始化: {CURRENT_VIDEO_DEVICE}")
+
+        # 按截止时间节拍采集：处理耗时从帧间隔中扣除，落后超过一帧时不再追赶
+        deadline = time.monotonic()
         while running_flag.is_set():
             ret, frame = cap.read()
             if not ret:
                 print("[设备端] 读取帧失败，重试摄像头初始化")
                 break
+            now = time.time()
+            analyze_q.put({"session": session, "id": frame_id, "ts": now, "frame": frame})
+            frame_id += 1
 
-            if frame_cnt % interval == 0:
-                g = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                faces = face_cascade.detectMultiScale(g, 1.1, 3, minSize=(40, 40))
-                cached_faces = faces
-            else:
-                faces = cached_faces
-
-            for (x, y, w, h) in faces:
-                roi = frame[y:y+h, x:x+w]
-                label = recognize(roi)
-                color = (0, 255, 0) if label != "Unknown" else (0, 0, 255)
-                cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
-                cv2.putText(frame, label, (x, y-10),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-
-            # ------ 新增：快递箱每秒检测计数 ------
-            count = package_counter.process(frame)
-            if count is not None:
-                print(f"[设备端] 每秒通过快递箱数量: {count}")
-                cv2.putText(frame,
-                            f"{count} pkg/s",
-                            (10, TARGET_HEIGHT - 10),
-                            cv2.FONT_HERSHEY_SIMPLEX,
-                            0.7,
-                            (0, 0, 255), 2)
-            # ────────────────────────────────────────
-
-            ok, encoded = cv2.imencode(".jpg", frame)
-            if not ok:
-                print("[设备端] 警告: 视频编码失败")
-                continue
-            try:
-                data = encoded.tobytes()
-                conn.sendall(b"VIDEO")
-                conn.sendall(len(data).to_bytes(4, 'big') + data)
-                time.sleep(1 / FPS)
-            except BrokenPipeError:
-                print("[设备端] 视频流断开")
-                running_flag.clear()
-                break
-            except Exception as e:
-                print(f"[设备端] 视频发送异常: {e}")
-                running_flag.clear()
-                break
-            frame_cnt += 1
+            if now - last_report >= PIPELINE_REPORT_INTERVAL:
+                report_pipeline((analyze_q, encode_q), stats, now - last_report, scheduler)
+                rep = controller.report()
+                print(f"[设备端] 码率控制 质量 {rep['quality']} 缩放 {rep['scale']} "
+                      f"帧率 {rep['fps']} 码率 {rep['kbps']} kbps 链路 {rep['link_kbps']} kbps")
+                last_report = now
+
+            # 帧率由码率控制器决定
+            period = 1.0 / controller.point["fps"]
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                deadline = time.monotonic()
 
         with device_lock:
             if cap is not None and cap.isOpened():
@@ -282,7 +1423,123 @@ def video_stream(conn):
         running_flag.clear()
     print("[设备端] 视频线程停止")
 
-def audio_stream(conn):
+# ------------------------------------------------------------------------
+# 音频编码：下混为单声道、线性插值重采样（跨块保持相位）、G.711 μ-law。
+# μ-law 用 65536 项查表整块向量化编码，解码表在客户端
+# ------------------------------------------------------------------------
+def _build_ulaw_table():
+    s = np.arange(-32768, 32768, dtype=np.int32)
+    sign = (s < 0).astype(np.int32)
+    mag = np.minimum(np.abs(s), 32635) + 0x84
+    exponent = np.clip(np.floor(np.log2(mag)).astype(np.int32) - 7, 0, 7)
+    mantissa = (mag >> (exponent + 3)) & 0x0F
+    return (~((sign << 7) | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+
+ULAW_ENCODE_TABLE = _build_ulaw_table()
+
+def ulaw_encode(samples):
+    return ULAW_ENCODE_TABLE[samples.astype(np.int32) + 32768]
+
+class AudioEncoder:
+    def __init__(self, codec="pcm16", rate=RATE, channels=CHANNELS):
+        self.codec = codec
+        self.rate = rate
+        self.channels = channels
+        self.step = RATE / float(rate)
+        self.pos = 0.0      # 下一个输出采样在输入流中的位置（相对上一块最后一个采样）
+        self.tail = None    # 上一块最后一个采样，用于跨块插值
+
+    @property
+    def format(self):
+        return {"codec": self.codec, "rate": self.rate, "channels": self.channels}
+
+    # 本块 count 个输入采样对应的输出采样位置（相对上一块最后一个采样），并推进相位
+    def _positions(self, count):
+        if self.pos > count:
+            self.pos -= count
+            return np.zeros(0)
+        n = int((count - self.pos) // self.step) + 1
+        t = self.pos + np.arange(n) * self.step
+        self.pos = t[-1] + self.step - count
+        return t
+
+    def _resample(self, x):
+        if self.tail is None:
+            self.tail = x[:1]
+            self.pos = 1.0
+        t = self._positions(len(x))
+        x = np.concatenate([self.tail, x])
+        self.tail = x[-1:]
+        i = t.astype(np.int64)
+        frac = (t - i)[:, None]
+        return x[i] * (1 - frac) + x[np.minimum(i + 1, len(x) - 1)] * frac
+
+    def _mix(self, pcm):
+        x = np.frombuffer(pcm, np.int16).reshape(-1, CHANNELS).astype(np.float32)
+        if self.channels == 1 and CHANNELS > 1:
+            x = x.mean(axis=1, keepdims=True)
+        return x
+
+    # 静音块不编码，只推进重采样相位，返回这块对应的输出采样数
+    def skip(self, pcm):
+        if self.rate == RATE:
+            return len(pcm) // (2 * CHANNELS)
+        x = self._mix(pcm)
+        if self.tail is None:
+            self.tail = x[:1]
+            self.pos = 1.0
+        self.tail = x[-1:]
+        return len(self._positions(len(x)))
+
+    def encode(self, pcm):
+        if self.codec == "pcm16" and self.rate == RATE and self.channels == CHANNELS:
+            return pcm
+        x = self._mix(pcm)
+        if self.rate != RATE:
+            x = self._resample(x)
+        x = np.clip(np.round(x), -32768, 32767).astype(np.int16)
+        if self.codec == "ulaw":
+            return ulaw_encode(x).tobytes()
+        return x.tobytes()
+
+# ------------------------------------------------------------------------
+# 静音门限：整块向量化计算 RMS / 峰值，带拖尾（hangover）
+# ------------------------------------------------------------------------
+class SilenceGate:
+    def __init__(self, rms=AUDIO_SILENCE_RMS, peak=AUDIO_SILENCE_PEAK, hangover=AUDIO_SILENCE_HANGOVER):
+        self.rms = rms
+        self.peak = peak
+        self.hangover_chunks = int(np.ceil(hangover * RATE / CHUNK))
+        self.remaining = 0
+        self.silent_chunks = 0
+        self.total_chunks = 0
+
+    def is_silent(self, pcm):
+        x = np.frombuffer(pcm, np.int16).astype(np.float32)
+        self.total_chunks += 1
+        if len(x) and (np.abs(x).max() > self.peak or np.sqrt(np.dot(x, x) / len(x)) > self.rms):
+            self.remaining = self.hangover_chunks
+            return False
+        if self.remaining > 0:
+            self.remaining -= 1
+            return False
+        self.silent_chunks += 1
+        return True
+
+# 当前会话协商出的音频格式，由 command_listener 写入、audio_stream 读取
+audio_format = {"codec": "pcm16", "rate": RATE, "channels": CHANNELS}
+
+def negotiate_audio(args):
+    global audio_format
+    opts = dict(a.split("=", 1) for a in args if "=" in a)
+    offered = opts.get("codecs", "pcm16").split(",")
+    codec = next((c for c in AUDIO_CODEC_PREFERENCE if c in offered), "pcm16")
+    rate = min(int(opts.get("rate", RATE)), RATE)
+    channels = max(1, min(int(opts.get("channels", CHANNELS)), CHANNELS))
+    audio_format = {"codec": codec, "rate": rate, "channels": channels}
+    print(f"[设备端] 音频编码协商结果: {audio_format}")
+
+def audio_stream(scheduler):
     pa, stream = None, None
     for i in range(3):
         try:
@@ -308,17 +1565,42 @@ def audio_stream(conn):
             print(f"[设备端] 音频初始化错误: {e}")
             time.sleep(2)
 
+    encoder = None
+    # 旧协议无法表示静音标记，只在 v2 下启用
+    gate = SilenceGate() if AUDIO_SILENCE_SUPPRESS and scheduler.wire.version >= 2 else None
+    marker_max = int(AUDIO_SILENCE_MARKER_SECONDS * RATE / CHUNK) or 1
+    silence = None      # 尚未发出的静音 [起始时间, 采样数, 块数]
+    clock_start, clock_samples = None, 0
     while running_flag.is_set() and stream:
         try:
             audio_data = stream.read(CHUNK, exception_on_overflow=False)
-            conn.sendall(b"AUDIO")
-            conn.sendall(len(audio_data).to_bytes(4, 'big') + audio_data)
-        except BrokenPipeError:
-            print("[设备端] 音频流断开")
-            running_flag.clear()
-            break
+            # 时间戳按采样计数推算（起点 + 已采样数 / RATE），相邻块首尾严格相接；
+            # 读返回时刻的抖动不会变成客户端看到的空缺或重叠
+            wall = time.time() - CHUNK / float(RATE)
+            ts = clock_start + clock_samples / float(RATE) if clock_start is not None else None
+            if ts is None or abs(ts - wall) > AUDIO_CLOCK_RESYNC:
+                clock_start, clock_samples, ts = wall, 0, wall
+            clock_samples += CHUNK
+            if encoder is None or encoder.format != audio_format:
+                # 尚未发出的静音按旧格式计数，与排队的旧格式音频一起丢弃
+                silence = None
+                encoder = AudioEncoder(**audio_format)
+                scheduler.send_audio_format(json.dumps({"audio": encoder.format}).encode("utf-8"))
+            if gate and gate.is_silent(audio_data):
+                if silence is None:
+                    silence = [ts, 0, 0]
+                silence[1] += encoder.skip(audio_data)
+                silence[2] += 1
+                if silence[2] >= marker_max:
+                    scheduler.send_audio(struct.pack(">I", silence[1]), silence[0], FLAG_SILENCE)
+                    silence = None
+                continue
+            if silence:
+                scheduler.send_audio(struct.pack(">I", silence[1]), silence[0], FLAG_SILENCE)
+                silence = None
+            scheduler.send_audio(encoder.encode(audio_data), ts)
         except Exception as e:
-            print(f"[设备端] 音频发送异常: {e}")
+            print(f"[设备端] 音频采集异常: {e}")
             running_flag.clear()
             break
 
@@ -327,19 +1609,28 @@ def audio_stream(conn):
         stream.close()
     if pa:
         pa.terminate()
+    if gate and gate.total_chunks:
+        print(f"[设备端] 静音抑制: {gate.silent_chunks}/{gate.total_chunks} 块未发送音频数据")
     print("[设备端] 音频线程停止")
 
 def command_listener(conn):
     while running_flag.is_set():
         try:
-            cmd = conn.recv(1024).decode().strip()
-            if not cmd:
+            data = conn.recv(1024).decode()
+            if not data:
                 running_flag.clear()
                 break
-            if cmd in VIDEO_DEVICES:
-                switch_video_device(cmd)
-            else:
-                print(f"[设备端] 未知命令: {cmd}")
+            # 新客户端每条命令以换行结尾；旧客户端一次只发一条不带换行的命令
+            for cmd in data.split("\n"):
+                cmd = cmd.strip()
+                if not cmd:
+                    continue
+                if cmd in VIDEO_DEVICES:
+                    switch_video_device(cmd)
+                elif cmd.startswith("AUDIO "):
+                    negotiate_audio(cmd.split()[1:])
+                else:
+                    print(f"[设备端] 未知命令: {cmd}")
         except Exception as e:
             print(f"[设备端] 命令监听异常: {e}")
             running_flag.clear()
@@ -347,7 +1638,7 @@ def command_listener(conn):
     print("[设备端] 命令线程停止")
 
 def receive_template():
-    global templates
+    global templates, template_version
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     srv.bind(("0.0.0.0", TEMPLATE_PORT))
@@ -374,13 +1665,17 @@ def receive_template():
                 kp, des = orb.detectAndCompute(gray, None)
                 if des is not None:
                     templates[name] = (kp, des)
+                    template_index.add(name, des)
+                    if recog_pool is not None:
+                        recog_pool.add_template(name, des)
+                    template_version += 1
             except Exception as e:
                 print(f"[ERROR] 模板接收异常: {e}")
     srv.close()
     print("[INFO] 模板线程停止")
 
 def receive_delete_request():
-    global templates
+    global templates, template_version
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     srv.bind(("0.0.0.0", DELETE_PORT))
@@ -396,13 +1691,94 @@ def receive_delete_request():
                 if os.path.exists(path):
                     os.remove(path)
                     templates.pop(name, None)
+                    template_index.remove(name)
+                    if recog_pool is not None:
+                        recog_pool.remove_template(name)
+                    template_version += 1
                     print(f"[INFO] 删除模板 {name}")
             except Exception as e:
                 print(f"[ERROR] 删除请求异常: {e}")
     srv.close()
     print("[INFO] 删除线程停止")
 
+# ------------------------------------------------------------------------
+# 基准测试：python3 faceDetectv7.1.py bench-templates
+# 对比逐人 bf.match 循环与 TemplateIndex 单次匹配随模板数量的延迟
+# ------------------------------------------------------------------------
+def bench_templates(counts=(10, 50, 100, 200, 400), per_template=500,
+                    query_size=200, repeat=20):
+    rng = np.random.RandomState(0)
+    query = rng.randint(0, 256, (query_size, 32)).astype(np.uint8)
+    print(f"{'模板数':>6} {'逐人循环(ms)':>12} {'索引-暴力(ms)':>12} {'索引-LSH(ms)':>12}")
+
+    def timed(fn):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        return (time.perf_counter() - t0) * 1000 / repeat
+
+    for n in counts:
+        people = {f"p{i}": rng.randint(0, 256, (per_template, 32)).astype(np.uint8)
+                  for i in range(n)}
+        brute = TemplateIndex(MATCH_DISTANCE, lsh_min=n + 1)
+        lsh = TemplateIndex(MATCH_DISTANCE, lsh_min=0)
+        brute.add_many(people)
+        lsh.add_many(people)
+
+        def per_person():
+            for t_des in people.values():
+                [m for m in bf.match(t_des, query) if m.distance < MATCH_DISTANCE]
+
+        loop_ms = timed(per_person)
+        brute_ms = timed(lambda: brute.match(query))
+        lsh_ms = timed(lambda: lsh.match(query))
+        print(f"{n:>6} {loop_ms:>12.2f} {brute_ms:>12.2f} {lsh_ms:>12.2f}")
+
+# ------------------------------------------------------------------------
+# 基准测试：python3 faceDetectv7.1.py bench-boxcounter <录像文件> [x,y,w,h]
+# 同一段录像在不同处理比例下回放，对比每帧检测数与耗时
+# ------------------------------------------------------------------------
+def bench_boxcounter(path, roi=None, scales=(1.0, 0.5, 0.25)):
+    src = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ret, frame = src.read()
+        if not ret:
+            break
+        frames.append(frame)
+    src.release()
+    if not frames:
+        print(f"[bench] 无法读取录像: {path}")
+        return
+    print(f"[bench] {path}: {len(frames)} 帧, ROI={roi}")
+    print(f"{'比例':>6} {'ms/帧':>8} {'检测总数':>8} {'逐帧一致率':>10} {'越线计数':>8} {'加速比':>8}")
+
+    baseline, base_ms = None, None
+    for scale in scales:
+        counter = BoxCounter(roi=roi, scale=scale)
+        counts, crossed = [], 0
+        t0 = time.perf_counter()
+        for frame in frames:
+            polys = counter.detect(frame)
+            crossed += counter.track(polys, counter._line(frame))[0]
+            counts.append(len(polys))
+        ms = (time.perf_counter() - t0) * 1000 / len(frames)
+        counts = np.array(counts)
+        if baseline is None:
+            baseline, base_ms = counts, ms
+        agree = float(np.mean(counts == baseline))
+        print(f"{scale:>6.2f} {ms:>8.2f} {int(counts.sum()):>8} {agree:>10.1%} "
+              f"{crossed:>8} {base_ms / ms:>7.1f}x")
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-templates":
+        bench_templates()
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == "bench-boxcounter":
+        roi = tuple(int(v) for v in sys.argv[3].split(",")) if len(sys.argv) > 3 else None
+        bench_boxcounter(sys.argv[2], roi)
+        sys.exit(0)
+
     for dev in VIDEO_DEVICES:
         if not os.access(dev, os.R_OK):
             print(f"没有权限访问 {dev}，请 chmod")
@@ -411,6 +1787,9 @@ if __name__ == "__main__":
     try:
         load_face_cascade()
         load_existing_templates()
+        # 进程池须在其他线程启动前 fork
+        if RECOG_WORKERS > 0:
+            recog_pool = RecognitionPool(RECOG_WORKERS)
     except Exception as e:
         print(f"初始化失败: {e}")
         sys.exit(1)
@@ -420,10 +1799,12 @@ if __name__ == "__main__":
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((SERVER_IP, PORT))
         print(f"[设备端] 连接到 {SERVER_IP}:{PORT}")
+        scheduler = SendScheduler(WireWriter(sock))
 
         threads = [
-            threading.Thread(target=video_stream, args=(sock,), daemon=True),
-            threading.Thread(target=audio_stream, args=(sock,), daemon=True),
+            threading.Thread(target=scheduler.run, daemon=True),
+            threading.Thread(target=video_stream, args=(scheduler,), daemon=True),
+            threading.Thread(target=audio_stream, args=(scheduler,), daemon=True),
             threading.Thread(target=command_listener, args=(sock,), daemon=True),
             threading.Thread(target=receive_template, daemon=True),
             threading.Thread(target=receive_delete_request, daemon=True),
@@ -440,5 +1821,7 @@ if __name__ == "__main__":
         if sock:
             sock.close()
         running_flag.clear()
+        if recog_pool is not None:
+            recog_pool.close()
         time.sleep(1)
         sys.exit(0)
\ No newline at end of file